@@ -0,0 +1,691 @@
+import json
+import math
+import os
+import pickle
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import stampede
+
+
+def populated_preset(choice, density=50, seed=0):
+    grid = stampede.create_preset_grid(choice, seed)
+    walkable_count = grid.count("walkable")
+    stampede.place_people(grid, int((density / 100) * walkable_count), 50, 50, 50)
+    return grid
+
+
+class RescanningExitIndex:
+    # What the A* heuristic and the movement sort key did before the exit index existed:
+    # look for the exits all over again on every lookup
+    def __init__(self, grid):
+        self.grid = grid
+
+    def nearest_exit_distance(self, index):
+        location = (index % self.grid.cols, index // self.grid.cols)
+        return stampede.heuristic(
+            location,
+            stampede.find_nearest_exit(stampede.find_exits(self.grid), location),
+        )
+
+
+def time_call(func, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_exit_index():
+    # One step's worth of A* searches (with person obstacles) and the pre-movement sort
+    # on the 50x20 hallway, once rescanning the grid for exits per lookup and once with
+    # the exit index
+    grid = populated_preset("3")
+    people = list(grid.world.people.values())
+
+    def one_step():
+        for person in people:
+            person.a_star(grid, person.location, True)
+        sorted(
+            people,
+            key=lambda person: stampede.nearest_exit_distance(grid, person.location),
+        )
+
+    indexed = stampede.exit_index
+    try:
+        stampede.exit_index = RescanningExitIndex
+        before = time_call(one_step)
+    finally:
+        stampede.exit_index = indexed
+    after = time_call(one_step)
+
+    print(f"exit index, 50x20 hallway, {len(people)} people, one step of lookups")
+    print(f"  rescanning find_exits: {before * 1000:9.1f} ms")
+    print(f"  exit index:            {after * 1000:9.1f} ms")
+    print(f"  speedup:               {before / after:9.1f}x")
+
+
+def time_subprocess(code, repeat=5):
+    # Best wall time of a fresh interpreter running code from the repository directory
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_startup():
+    # Process startup for non-visual work: a bare interpreter, importing stampede, and
+    # importing it plus a headless run of the 5x5 debug1 scenario. The rendering stack
+    # is timed on its own for reference; none of the other runs should be paying for it.
+    headless_run = (
+        "import sys, stampede; sys.argv = ['stampede.py', 'debug1', '--headless']; "
+        "stampede.main(); "
+        "assert 'matplotlib' not in sys.modules and 'IPython' not in sys.modules"
+    )
+    timings = [
+        ("python (no imports)", "pass"),
+        ("import stampede", "import stampede"),
+        ("import + debug1 headless run", headless_run),
+        (
+            "import matplotlib/IPython",
+            "import matplotlib.pyplot, matplotlib.patches, IPython.display",
+        ),
+    ]
+
+    print("startup, best of 5 fresh interpreters")
+    for label, code in timings:
+        try:
+            elapsed = time_subprocess(code)
+        except subprocess.CalledProcessError:
+            print(f"  {label + ':':31} failed")
+            continue
+        print(f"  {label + ':':31} {elapsed * 1000:7.1f} ms")
+
+
+def world_state(grid):
+    # Everything a step can change: who stands where, everyone's traits, status and
+    # counters, and the order people act in
+    agents = grid.world.agents
+    return (
+        grid.occupants.tobytes(),
+        [getattr(agents, name).tobytes() for name in agents.FLAGS + agents.COUNTERS],
+        list(grid.world.people),
+    )
+
+
+def bench_movement():
+    # Parity and timing of the batched movement engine against the original
+    # person-by-person loop. Both runs of a scenario start from the same pickled state
+    # and must match after every step.
+    scenarios = [
+        ("debug1", *stampede.create_debug_scenario("debug1")),
+        ("debug2", *stampede.create_debug_scenario("debug2")),
+    ] + [
+        (f"preset {choice}, 50%", populated_preset(choice), 60)
+        for choice in ["3", "4", "5"]
+    ]
+
+    # Warm up first so neither engine is charged for importing numpy
+    stampede.simulate(stampede.create_debug_scenario("debug1")[0], 1)
+    print("movement engines, whole steps including pathfinding")
+    for name, grid, steps in scenarios:
+        grids = {
+            engine: pickle.loads(pickle.dumps(grid)) for engine in ["loop", "batched"]
+        }
+        elapsed = {"loop": 0.0, "batched": 0.0}
+        mismatch = None
+        for step_number in range(1, steps + 1):
+            for engine, engine_grid in grids.items():
+                start = time.perf_counter()
+                stampede.step(engine_grid, engine)
+                elapsed[engine] += time.perf_counter() - start
+            if mismatch is None and world_state(grids["loop"]) != world_state(
+                grids["batched"]
+            ):
+                mismatch = step_number
+        parity = "identical" if mismatch is None else f"DIFFERS from step {mismatch}"
+        print(
+            f"  {name + ':':17} {steps:3} steps"
+            f"  loop {elapsed['loop'] * 1000:8.1f} ms"
+            f"  batched {elapsed['batched'] * 1000:8.1f} ms  {parity}"
+        )
+
+
+def bench_render(frames=5):
+    # Per-frame cost of drawing the 50x20 hallway at 50% density with the Agg backend,
+    # with and without id labels, next to the cost of the simulation step it shows
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    print("rendering, 50x20 hallway at 50% density, Agg")
+    for show_ids in [True, False]:
+        grid = populated_preset("3")
+        fig, ax = plt.subplots(figsize=(10, 8))
+        start = time.perf_counter()
+        stampede.draw_grid(grid, ax, show_ids)
+        fig.canvas.draw()
+        first = time.perf_counter() - start
+
+        stepping = drawing = 0.0
+        for _ in range(frames):
+            start = time.perf_counter()
+            stampede.step(grid)
+            stepping += time.perf_counter() - start
+            start = time.perf_counter()
+            stampede.draw_grid(grid, ax, show_ids)
+            fig.canvas.draw()
+            drawing += time.perf_counter() - start
+        plt.close(fig)
+
+        print(f"  {'with' if show_ids else 'without'} id labels:")
+        print(f"    first frame:       {first * 1000:8.1f} ms")
+        print(f"    later frames:      {drawing / frames * 1000:8.1f} ms each")
+        print(f"    simulation step:   {stepping / frames * 1000:8.1f} ms each")
+
+
+def bench_flow_field():
+    # The pathfinding around other people for one step at 50% density: an A* search per
+    # standing person against one CongestionField shared by all of them
+    for choice, name in [
+        ("3", "50x20 hallway"),
+        ("4", "10x25 hallway"),
+        ("5", "10x25 safer"),
+    ]:
+        grid = populated_preset(choice)
+        people = [
+            person for person in grid.world.people.values() if not person.isFallen
+        ]
+
+        def searches():
+            for person in people:
+                person.a_star(grid, person.location, True)
+
+        def field():
+            congestion = stampede.CongestionField(grid)
+            for person in people:
+                congestion.path(person.location)
+
+        before, after = time_call(searches), time_call(field)
+        print(f"flow field, {name}, {len(people)} people, one step of paths")
+        print(f"  A* per person:    {before * 1000:8.1f} ms")
+        print(f"  congestion field: {after * 1000:8.1f} ms  ({before / after:.1f}x)")
+
+
+def bench_shared_paths():
+    # Both routes of every standing person for one step at 50% and 90% density: an A*
+    # search per person plus a full walk of the distance field, as before ExitTree,
+    # against one ExitTree for the route around others and lazy paths that are only read
+    # up to path[1]
+    for choice, name in [
+        ("3", "50x20 hallway"),
+        ("4", "10x25 hallway"),
+        ("5", "10x25 safer"),
+    ]:
+        for density in (50, 90):
+            grid = populated_preset(choice, density)
+            people = [
+                person for person in grid.world.people.values() if not person.isFallen
+            ]
+            distances = stampede.exit_distance_field(grid)
+
+            def searches():
+                for person in people:
+                    path = person.a_star(grid, person.location, True)
+                    path and path[1:2]
+                    # The old path_from_distance_field, building the whole coordinate
+                    # list
+                    current = person.location.index
+                    walked = [current]
+                    while distances[current]:
+                        current = next(
+                            neighbor
+                            for neighbor in grid.neighbor_indexes(current)
+                            if distances[neighbor] == distances[current] - 1
+                        )
+                        walked.append(current)
+
+            def shared():
+                tree = stampede.ExitTree(grid, person_obstacles=True)
+                for person in people:
+                    for path in (
+                        tree.path(person.location),
+                        stampede.path_from_distance_field(grid, person.location),
+                    ):
+                        path and path[1:2]
+
+            before, after = time_call(searches), time_call(shared)
+            print(
+                f"shared paths, {name}, {density}%, {len(people)} people,"
+                " one step of paths"
+            )
+            print(f"  A* and full walks: {before * 1000:8.1f} ms")
+            print(
+                f"  shared ExitTree:   {after * 1000:8.1f} ms  ({before / after:.1f}x)"
+            )
+
+
+def bench_path_cache(steps=30, sizes=(64, 256, 1024, 4096)):
+    # Pathfinding time per step and PathCache hit rates on the hallways at 10%, 50% and
+    # 90% density, for a few cache sizes against plain A* (sparse=False) and the
+    # ActiveSet (sparse=True). Every run starts from the same crowd, but "cached" routes
+    # can break ties differently from A*, so the runs drift apart.
+    for choice, name in [("3", "50x20 hallway"), ("4", "10x25 hallway")]:
+        for density in (10, 50, 90):
+            blob = pickle.dumps(populated_preset(choice, density))
+            print(f"path cache, {name}, {density}%, {steps} steps")
+            runs = [("a_star", False, None), ("a_star", True, None)]
+            runs += [("cached", True, size) for size in sizes]
+            for pathfinding, sparse, size in runs:
+                grid = pickle.loads(blob)
+                if size is not None:
+                    grid.cached("path_cache", stampede.PathCache).maxsize = size
+                profiler = stampede.StepProfiler()
+                stampede.simulate(
+                    grid,
+                    steps,
+                    pathfinding=pathfinding,
+                    sparse=sparse,
+                    profiler=profiler,
+                )
+                totals = profiler.totals()
+                milliseconds = totals["pathfinding"] / len(profiler.rows) * 1000
+                if size is None:
+                    label = "A* + active set" if sparse else "A*"
+                    print(f"  {label:<16} {milliseconds:7.2f} ms/step")
+                else:
+                    queries = totals["cache_hits"] + totals["cache_misses"]
+                    suffixes = grid.cached("path_cache", stampede.PathCache).suffixes
+                    print(
+                        f"  cache {size:<10} {milliseconds:7.2f} ms/step"
+                        f"  {totals['cache_hits'] / max(queries, 1):6.1%} hits"
+                        f"  {suffixes:6d} suffixes"
+                    )
+
+
+def bench_incremental(steps=30):
+    # Node expansions per step of the route around other people on the 10x25 hallways at
+    # 10% and 50% density: an A* search from scratch per person, one ExitTree searched
+    # from scratch for everyone, and one IncrementalExitTree repaired between steps. All
+    # see the same states, from a run driven by A*, and the step that first builds the
+    # IncrementalExitTree is left out of the per-step figures.
+    hallways = [("4", "10x25 hallway"), ("5", "10x25 safer")]
+    cases = [
+        (choice, name, density) for choice, name in hallways for density in (10, 50)
+    ]
+    for choice, name, density in cases:
+        grid = populated_preset(choice, density)
+        context = stampede.search_context(grid)
+        tree = stampede.IncrementalExitTree(grid)
+        searched = rebuilt = repaired = 0
+        search_time = rebuild_time = repair_time = 0.0
+        for step_number in range(steps + 1):
+            people = [
+                person
+                for person in grid.world.people.values()
+                if not person.isDead and not person.isFallen
+            ]
+            start = time.perf_counter()
+            for person in people:
+                stampede.find_path(grid, person.location, True, context=context)
+                searched += context.closed.count(context.stamp)
+            search_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            fresh = stampede.ExitTree(grid, person_obstacles=True)
+            rebuild_time += time.perf_counter() - start
+            rebuilt += len(fresh.steps) - fresh.steps.count(None)
+
+            start = time.perf_counter()
+            before = tree.expansions
+            tree.refresh()
+            repaired += tree.expansions - before
+            repair_time += time.perf_counter() - start
+            if step_number == 0:
+                searched = rebuilt = repaired = 0
+                search_time = rebuild_time = repair_time = 0.0
+            stampede.step(grid)
+
+        print(f"incremental exit tree, {name}, {density}%, {steps} steps")
+        for label, expansions, elapsed in [
+            ("A* per person:", searched, search_time),
+            ("fresh ExitTree:", rebuilt, rebuild_time),
+            ("repaired tree:", repaired, repair_time),
+        ]:
+            print(
+                f"  {label:16} {expansions / steps:8.0f} expansions/step"
+                f"  {elapsed / steps * 1000:6.2f} ms/step"
+            )
+
+
+def venue(rows, cols, seed=0):
+    # A large open floor with a 4x4 pillar every 20 cells, random 30-cell walls and a
+    # 4-cell exit every 200 cells along the top and bottom edges
+    rng = random.Random(seed)
+    grid = stampede.create_grid(rows, cols)
+    cell_types = grid.cell_types
+    for y in range(10, rows - 10, 20):
+        for x in range(10, cols - 10, 20):
+            for dy in range(4):
+                for dx in range(4):
+                    cell_types[(y + dy) * cols + x + dx] = stampede.OBSTACLE
+    for _ in range(rows * cols // 2000):
+        y, x = rng.randrange(rows), rng.randrange(cols - 30)
+        for dx in range(30):
+            cell_types[y * cols + x + dx] = stampede.OBSTACLE
+    for x in range(50, cols - 4, 200):
+        for dx in range(4):
+            cell_types[x + dx] = cell_types[(rows - 1) * cols + x + dx] = stampede.EXIT
+    grid.layout_changed()
+    return grid
+
+
+def bench_hierarchy(size=500, queries=200):
+    # Routes to the nearest exit across a size x size venue: building the PathHierarchy,
+    # rebuilding it after one cell changes, and queries against A* over the whole grid
+    grid = venue(size, size)
+    rng = random.Random(1)
+    starts = [
+        index
+        for index in rng.sample(range(size * size), 2 * queries)
+        if grid.cell_types[index] == stampede.WALKABLE
+    ][:queries]
+
+    start = time.perf_counter()
+    path_hierarchy = stampede.hierarchy(grid)
+    build = time.perf_counter() - start
+    nodes = sum(len(nodes) for nodes in path_hierarchy.nodes.values())
+
+    start = time.perf_counter()
+    paths = [path_hierarchy.path(grid.cell(index)) for index in starts]
+    query = (time.perf_counter() - start) / len(starts)
+    start = time.perf_counter()
+    for path in paths:
+        if path:
+            list(path)
+    refine = (time.perf_counter() - start) / len(starts)
+
+    searched = starts[: queries // 10]
+    start = time.perf_counter()
+    a_star_paths = [stampede.find_path(grid, grid.cell(index)) for index in searched]
+    search = (time.perf_counter() - start) / len(searched)
+    ratios = [len(path) / len(best) for path, best in zip(paths, a_star_paths) if best]
+
+    grid.cell(starts[0]).cellType = "obstacle"
+    start = time.perf_counter()
+    stampede.hierarchy(grid)
+    rebuild = time.perf_counter() - start
+
+    clusters = len(path_hierarchy.nodes)
+    print(f"path hierarchy, {size}x{size} venue, {clusters} clusters, {nodes} nodes")
+    print(f"  build:                 {build * 1000:9.1f} ms")
+    print(f"  rebuild, one cell:     {rebuild * 1000:9.1f} ms")
+    print(f"  A* over the grid:      {search * 1000:9.2f} ms per route")
+    print(f"  hierarchy query:       {query * 1000:9.2f} ms per route")
+    print(f"  whole route refined:   {refine * 1000:9.2f} ms per route")
+    mean, worst = sum(ratios) / len(ratios), max(ratios)
+    print(f"  length vs A*:          {mean:9.3f}x mean, {worst:.3f}x worst")
+
+
+def bench_parallel(size=200, people=500, steps=2):
+    # The pathfinding phase of a few steps on a size x size venue, in this process and
+    # across PathfindingPools of 1, 2, 4, ... workers up to the number of cores, all of
+    # which must find the same paths
+    grid = venue(size, size)
+    grid.world.seed(0)
+    stampede.place_people(grid, people, 50, 50, 50)
+    blob = pickle.dumps(grid)
+    print(f"parallel pathfinding, {size}x{size} venue, {people} people, {steps} steps")
+
+    def run(workers):
+        run_grid = pickle.loads(blob)
+        pool = stampede.PathfindingPool(run_grid, workers) if workers else None
+        pathfinding = 0.0
+        try:
+            for _ in range(steps):
+                start = time.perf_counter()
+                if pool is None:
+                    for person in run_grid.world.people.values():
+                        if not person.isDead and not person.isFallen:
+                            person.a_star(run_grid, person.location, True)
+                            stampede.path_from_distance_field(run_grid, person.location)
+                else:
+                    pool.find_paths(run_grid)
+                pathfinding += time.perf_counter() - start
+                stampede.step(run_grid, pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+        return pathfinding / steps, run_grid.occupants
+
+    serial, occupants = run(None)
+    print(f"  in process:  {serial * 1000:9.1f} ms/step")
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        parallel, parallel_occupants = run(workers)
+        same = "identical" if parallel_occupants == occupants else "DIFFERENT"
+        print(
+            f"  {workers:2d} workers:  {parallel * 1000:9.1f} ms/step  "
+            f"({serial / parallel:.1f}x, {same})"
+        )
+        workers *= 2
+
+
+BENCHMARKS = {
+    "exit_index": bench_exit_index,
+    "startup": bench_startup,
+    "movement": bench_movement,
+    "render": bench_render,
+    "flow_field": bench_flow_field,
+    "shared_paths": bench_shared_paths,
+    "path_cache": bench_path_cache,
+    "incremental": bench_incremental,
+    "hierarchy": bench_hierarchy,
+    "parallel": bench_parallel,
+}
+
+
+# Steps run per suite case at each scale, so bigger grids still finish in reasonable
+# time
+SUITE_STEPS = {1: 20, 10: 5, 100: 2}
+
+
+def scaled_preset(choice, scale=1, density=50, seed=0):
+    # A preset grid with about scale times as many cells, resampled nearest-neighbor so
+    # walls, obstacles and exits grow with it, populated to density percent of its
+    # walkable cells. At scale 1 this is the preset itself, including preset 1's own
+    # three people.
+    grid = stampede.create_preset_grid(choice, seed)
+    if scale != 1:
+        factor = math.sqrt(scale)
+        rows, cols = round(grid.rows * factor), round(grid.cols * factor)
+        codes = stampede.array("b", bytes(rows * cols))
+        for i in range(rows):
+            source_row = (i * grid.rows // rows) * grid.cols
+            for j in range(cols):
+                codes[i * cols + j] = grid.cell_types[
+                    source_row + j * grid.cols // cols
+                ]
+        grid = stampede.create_grid(rows, cols, codes)
+    grid.world.seed(seed)
+    walkable_count = grid.count("walkable")
+    stampede.place_people(grid, int((density / 100) * walkable_count), 50, 50, 50)
+    return grid
+
+
+def run_case(case):
+    # One suite case, run in its own process (see bench_suite) so peak RSS is its own
+    import resource
+
+    grid = scaled_preset(case["preset"], case["scale"], case["density"], case["seed"])
+    people = len(grid.world.people)
+    blob = pickle.dumps(grid)
+    context = stampede.search_context(grid)
+    searches = context.stamp
+    profiler = stampede.StepProfiler()
+    start = time.perf_counter()
+    # A case that settles stops early, so its rate is over the steps it actually ran
+    steps = len(stampede.simulate(grid, case["steps"], profiler=profiler))
+    elapsed = time.perf_counter() - start
+    calls = context.stamp - searches
+    totals = profiler.totals()
+    # Quick cases are run again from the same start until a second has been spent on
+    # them, and the median run counts, so timer noise does not read as a regression
+    runs, spent = [elapsed], elapsed
+    while spent < 1.0:
+        grid = pickle.loads(blob)
+        start = time.perf_counter()
+        stampede.simulate(grid, case["steps"])
+        rerun = time.perf_counter() - start
+        runs.append(rerun)
+        spent += rerun
+    elapsed = statistics.median(runs)
+    return dict(
+        case,
+        rows=grid.rows,
+        cols=grid.cols,
+        people=people,
+        steps_per_sec=steps / elapsed,
+        a_star_calls=calls,
+        expansions=totals["expansions"],
+        heap_pushes=totals["heap_pushes"],
+        moves=totals["moves"],
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+def _case_key(result):
+    return (result["preset"], result["scale"], result["density"])
+
+
+def bench_suite(args=()):
+    # Every preset at 1x, 10x and 100x its cells and 10/50/90% density with fixed seeds,
+    # each in a fresh interpreter. --save PATH writes the results as a baseline;
+    # --compare PATH flags cases that got more than --tolerance (default 20%) slower or
+    # bigger, or whose A* work changed, which means the simulation itself behaves
+    # differently.
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="benchmark.py suite")
+    parser.add_argument("--presets", default="1,2,3,4,5")
+    parser.add_argument("--scales", default="1,10,100")
+    parser.add_argument("--densities", default="10,50,90")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    options = parser.parse_args(args)
+
+    results = []
+    print(
+        f"{'preset':>6} {'scale':>5} {'dens':>4} {'cells':>8}"
+        f" {'people':>7} {'steps':>5}"
+        f" {'steps/s':>9} {'A* calls':>9} {'expansions':>11} {'RSS MB':>7}"
+    )
+    for preset in options.presets.split(","):
+        for scale in map(int, options.scales.split(",")):
+            for density in map(int, options.densities.split(",")):
+                case = dict(
+                    preset=preset,
+                    scale=scale,
+                    density=density,
+                    seed=options.seed,
+                    steps=SUITE_STEPS.get(scale, 2),
+                )
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--case",
+                        json.dumps(case),
+                    ],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+                result = json.loads(output.splitlines()[-1])
+                results.append(result)
+                print(
+                    f"{preset:>6} {scale:>5} {density:>4}"
+                    f" {result['rows'] * result['cols']:>8}"
+                    f" {result['people']:>7} {result['steps']:>5}"
+                    f" {result['steps_per_sec']:>9.2f} {result['a_star_calls']:>9}"
+                    f" {result['expansions']:>11} {result['peak_rss_mb']:>7.1f}"
+                )
+
+    if options.save:
+        with open(options.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+        print(f"Saved {options.save}")
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = {
+                _case_key(result): result for result in json.load(baseline_file)
+            }
+        regressions = 0
+        for result in results:
+            before = baseline.get(_case_key(result))
+            if before is None:
+                continue
+            problems = []
+            if result["steps_per_sec"] < before["steps_per_sec"] * (
+                1 - options.tolerance
+            ):
+                problems.append(
+                    f"steps/s {before['steps_per_sec']:.2f}"
+                    f" -> {result['steps_per_sec']:.2f}"
+                )
+            if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + options.tolerance):
+                problems.append(
+                    f"RSS {before['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} MB"
+                )
+            if (result["a_star_calls"], result["expansions"]) != (
+                before["a_star_calls"],
+                before["expansions"],
+            ):
+                problems.append(
+                    f"A* work {before['a_star_calls']}/{before['expansions']}"
+                    f" -> {result['a_star_calls']}/{result['expansions']}"
+                )
+            if problems:
+                regressions += 1
+                print(f"REGRESSION {_case_key(result)}: {'; '.join(problems)}")
+        print(
+            f"{regressions} of {len(results)} cases regressed against {options.compare}"
+        )
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    if sys.argv[1:2] == ["--case"]:
+        print(json.dumps(run_case(json.loads(sys.argv[2]))))
+        return
+    # The suite has its own options and is not part of the default run
+    if sys.argv[1:2] == ["suite"]:
+        bench_suite(sys.argv[2:])
+        return
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            continue
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
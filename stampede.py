@@ -1,36 +1,85 @@
 import sys
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from IPython.display import clear_output
+import json
+import os
 import random
 import math
 import heapq
+import threading
+import time
+import contextlib
+import bisect
+import itertools
+import struct
+import zlib
+import weakref
+from array import array
+from collections import OrderedDict, deque
+
+# Cell types as stored in Grid.cell_types
+CELL_TYPES = ["walkable", "obstacle", "exit"]
+WALKABLE, OBSTACLE, EXIT = range(len(CELL_TYPES))
+CELL_TYPE_CODES = {name: code for code, name in enumerate(CELL_TYPES)}
+# Grid.occupants entry of a cell nobody is standing on
+EMPTY = -1
 
 
 class Cell:
-    def __init__(self, cellType="walkable"):
-        self.occupied = None
-        self.cellType = cellType
-        self.north = None
-        self.south = None
-        self.east = None
-        self.west = None
-        self.x = None
-        self.y = None
-
-        self.parent = None
-        self.g = float("inf")
-        self.f = float("inf")
-        self.h = 0
-
-    def __lt__(self, other):
-        return self.f < other.f
-
-    def set_neighbors(self, north=None, south=None, east=None, west=None):
-        self.north, self.south, self.east, self.west = north, south, east, west
+    # A view onto one cell of a Grid; its type and occupant live in the grid's arrays.
+    # Grids hand out a single view per cell (see Grid.cell), so cells compare and hash
+    # by identity.
+    __slots__ = ("grid", "index", "x", "y")
+
+    def __init__(self, grid, index):
+        self.grid = grid
+        # Position in the grid's flat arrays: y * cols + x
+        self.index = index
+        self.y, self.x = divmod(index, grid.cols)
+
+    def __reduce__(self):
+        return self.grid.cell, (self.index,)
+
+    @property
+    def cellType(self):
+        return CELL_TYPES[self.grid.cell_types[self.index]]
+
+    @cellType.setter
+    def cellType(self, value):
+        self.grid.cell_types[self.index] = CELL_TYPE_CODES[value]
+        # Let the grid know so cached layout data (e.g. the exit distance field) is
+        # rebuilt
+        self.grid.layout_changed()
+
+    @property
+    def occupied(self):
+        person_id = self.grid.occupants[self.index]
+        return None if person_id == EMPTY else self.grid.world.everyone[person_id]
+
+    @occupied.setter
+    def occupied(self, person):
+        self.grid.occupants[self.index] = EMPTY if person is None else person.id
+
+    @property
+    def north(self):
+        return self.grid.cell(self.index - self.grid.cols) if self.y > 0 else None
+
+    @property
+    def south(self):
+        return (
+            self.grid.cell(self.index + self.grid.cols)
+            if self.y < self.grid.rows - 1
+            else None
+        )
+
+    @property
+    def east(self):
+        return self.grid.cell(self.index + 1) if self.x < self.grid.cols - 1 else None
+
+    @property
+    def west(self):
+        return self.grid.cell(self.index - 1) if self.x > 0 else None
 
     def is_occupied(self):
-        return self.occupied is not None
+        return self.grid.occupants[self.index] != EMPTY
 
     def clear_if_exit(self):
         if self.cellType == "exit" and self.occupied:
@@ -43,41 +92,61 @@ class Cell:
         return grid[y][x]
 
 
-class Person:
-    all_people = []
-    id_counter = 0
+def _agent_field(name, kind=bool):
+    # A Person attribute that lives in its world's AgentStore array `name`, indexed by
+    # id
+    def get(person):
+        return kind(getattr(person.world.agents, name)[person.id])
 
-    def __init__(self, isStrong, isRational, isRelaxed, location):
-        self.id = Person.id_counter
-        Person.id_counter += 1
+    def set(person, value):
+        getattr(person.world.agents, name)[person.id] = int(value)
 
-        self.all_people.append(self)
+    return property(get, set)
+
+
+class Person:
+    # A view onto one row of its world's AgentStore. Only the world, the id and the
+    # current cell are kept on the object itself; traits, status flags and counters are
+    # array entries.
+    __slots__ = ("world", "id", "_location")
+
+    isStrong = _agent_field("is_strong")
+    isRational = _agent_field("is_rational")
+    isRelaxed = _agent_field("is_relaxed")
+    isFallen = _agent_field("is_fallen")
+    isDead = _agent_field("is_dead")
+    fallenCounter = _agent_field("fallen_counter", int)
+    blockedCounter = _agent_field("blocked_counter", int)
+    trampledCounter = _agent_field("trampled_counter", int)
+
+    def __init__(self, isStrong, isRational, isRelaxed, location, world=None):
+        # People belong to the world of the grid they are placed on unless told
+        # otherwise
+        if world is None:
+            world = location.grid.world
+        self.world = world
+        world.add(self)
         self.isStrong = isStrong
         self.isRational = isRational
         self.isRelaxed = isRelaxed
         self.location = location
-        self.vulnerable = not isStrong and not isRelaxed
-        self.isFallen = False
-        self.isDead = False
-        self.fallenCounter = 0
-        self.blockedCounter = 0
-        self.trampledCounter = 0
+
+    @property
+    def location(self):
+        return self._location
+
+    @location.setter
+    def location(self, cell):
+        self._location = cell
+        self.world.agents.x[self.id] = cell.x
+        self.world.agents.y[self.id] = cell.y
+
+    @property
+    def vulnerable(self):
+        return not self.isStrong and not self.isRelaxed
 
     def color(self):
-        if self.isDead:
-            return "black"
-        elif self.isFallen:
-            return "lightgrey"
-        elif self.isRelaxed:
-            return "green"
-        elif self.isStrong and not self.isRational and not self.isRelaxed:
-            return "red"
-        elif self.isStrong and self.isRational and not self.isRelaxed:
-            return "orange"
-        elif not self.isStrong and not self.isRational and not self.isRelaxed:
-            return "blue"
-        elif not self.isStrong and self.isRational and not self.isRelaxed:
-            return "purple"
+        return self.world.agents.colors([self.id])[0]
 
     def move_left(self):
         if self.location.west and not self.location.west.is_occupied():
@@ -104,19 +173,7 @@ class Person:
             self.location.occupied = self
 
     def update_status(self):
-        if self.isFallen:
-            if self.trampledCounter >= 3:
-                self.isFallen = False
-                self.isDead = True
-
-            self.fallenCounter += 1
-            if self.fallenCounter >= 3:
-                self.isFallen = False
-                self.fallenCounter = 0
-
-        if self.blockedCounter >= 3:
-            self.isRelaxed = False
-            self.blockedCounter = 0
+        self.world.agents.update_status(self.id)
 
     def fall(self):
         self.isFallen = True
@@ -138,88 +195,374 @@ class Person:
         self.trampledCounter = 0
 
     def a_star(self, grid, start, person_obstacles=False):
-        open_list = []
-        open_set = set()
-        closed_list = set()
-        start.parent = None
-        start.g = 0
-        start.f = start.h
-        heapq.heappush(open_list, (start.f, start))
-        open_set.add(start)
+        return find_path(grid, start, person_obstacles)
+
+
+class Grid:
+    # The floor plan as flat arrays indexed by Cell.index: cell_types holds each cell's
+    # type code and occupants the id of the person standing there (EMPTY if nobody).
+    # grid[i][j] and iterating over rows still give Cells, which are only created when
+    # first asked for, so even very large grids are quick to build. Data derived from
+    # the layout is cached until a cellType changes. Code that writes to cell_types
+    # directly instead of through Cell must call layout_changed() itself.
+    def __init__(self, rows, cols):
+        self.rows, self.cols = rows, cols
+        self.cell_types = array("b", bytes(rows * cols))
+        self.occupants = array("i", [EMPTY]) * (rows * cols)
+        self.world = None
+        self.layout_version = 0
+        self.layout_cache = {}
+        self.views = [None] * (rows * cols)
+        self.row_views = [GridRow(self, i) for i in range(rows)]
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        return self.row_views[i]
+
+    def __iter__(self):
+        return iter(self.row_views)
+
+    def cell(self, index):
+        view = self.views[index]
+        if view is None:
+            view = self.views[index] = Cell(self, index)
+        return view
+
+    def neighbor_indexes(self, index):
+        # Indexes of the cells north, south, east and west of index (the order A* looks
+        # at them in), leaving out the ones past the edge of the grid
+        cols = self.cols
+        y, x = divmod(index, cols)
+        neighbors = []
+        if y > 0:
+            neighbors.append(index - cols)
+        if y < self.rows - 1:
+            neighbors.append(index + cols)
+        if x < cols - 1:
+            neighbors.append(index + 1)
+        if x > 0:
+            neighbors.append(index - 1)
+        return neighbors
+
+    def count(self, cellType):
+        return self.cell_types.count(CELL_TYPE_CODES[cellType])
+
+    def layout_changed(self):
+        self.layout_version += 1
+        self.layout_cache.clear()
+
+    def cached(self, key, build):
+        # Returns build(self), reusing the result until a cellType on the grid changes
+        if key not in self.layout_cache:
+            self.layout_cache[key] = build(self)
+        return self.layout_cache[key]
+
+    def __reduce__(self):
+        # Unpickled through __init__ first, so the Cells of people on the grid can
+        # already be looked up while the rest of its state is still being restored
+        state = {
+            name: value
+            for name, value in self.__dict__.items()
+            if name not in ("views", "row_views", "layout_cache")
+        }
+        return Grid, (self.rows, self.cols), state
+
+
+class GridRow:
+    # grid[i]: row i of a Grid, indexable like the lists of Cells grids used to be made
+    # of
+    __slots__ = ("grid", "i")
+
+    def __init__(self, grid, i):
+        self.grid, self.i = grid, i
+
+    def __len__(self):
+        return self.grid.cols
+
+    def __getitem__(self, j):
+        cols = self.grid.cols
+        if j < 0:
+            j += cols
+        if not 0 <= j < cols:
+            raise IndexError("grid column out of range")
+        return self.grid.cell(self.i * cols + j)
+
+    def __iter__(self):
+        start = self.i * self.grid.cols
+        for index in range(start, start + self.grid.cols):
+            yield self.grid.cell(index)
+
+
+class AgentStore:
+    # Structure-of-arrays storage for the people of one World: one typed array per
+    # trait, status flag, counter and coordinate, indexed by Person.id. Rows of people
+    # who have left are kept but marked inactive. Whole-population passes (colours,
+    # counts) run over NumPy views of the arrays instead of attribute by attribute.
+    FLAGS = ["active", "is_strong", "is_rational", "is_relaxed", "is_fallen", "is_dead"]
+    COUNTERS = ["fallen_counter", "blocked_counter", "trampled_counter", "x", "y"]
+
+    # Indexed by the colour codes worked out in colors()
+    COLORS = ["black", "lightgrey", "green", "red", "orange", "blue", "purple"]
+
+    def __init__(self):
+        for name in self.FLAGS:
+            setattr(self, name, array("b"))
+        for name in self.COUNTERS:
+            setattr(self, name, array("i"))
+
+    def __len__(self):
+        return len(self.active)
+
+    def append(self):
+        for name in self.FLAGS + self.COUNTERS:
+            getattr(self, name).append(0)
+        self.active[-1] = 1
+        return len(self.active) - 1
+
+    def view(self, name):
+        import numpy as np
+
+        return np.frombuffer(
+            getattr(self, name), dtype=np.int8 if name in self.FLAGS else np.int32
+        )
 
-        while open_list:
-            current = heapq.heappop(open_list)[1]
-            if current in open_set:
-                open_set.remove(current)
-            else:
-                continue
+    def update_status(self, person_id):
+        # The status rules for one person, applied at the end of their own turn: fallen
+        # people die after being trampled 3 times and get back up after 3 steps down,
+        # and being blocked 3 times makes a relaxed person panic.
+        if self.is_fallen[person_id]:
+            if self.trampled_counter[person_id] >= 3:
+                self.is_fallen[person_id] = 0
+                self.is_dead[person_id] = 1
+            self.fallen_counter[person_id] += 1
+            if self.fallen_counter[person_id] >= 3:
+                self.is_fallen[person_id] = 0
+                self.fallen_counter[person_id] = 0
+
+        if self.blocked_counter[person_id] >= 3:
+            self.is_relaxed[person_id] = 0
+            self.blocked_counter[person_id] = 0
+
+    def restless(self):
+        # Number of active people whose status would still change with nobody moving:
+        # the fallen, who get up or die, and relaxed people still standing, who panic
+        # when blocked
+        import numpy as np
+
+        fallen = self.view("is_fallen") == 1
+        standing_relaxed = (
+            (self.view("is_relaxed") == 1) & (self.view("is_dead") == 0) & ~fallen
+        )
+        return int(
+            np.count_nonzero((self.view("active") == 1) & (fallen | standing_relaxed))
+        )
 
-            if current.cellType == "exit":
-                path = []
-                while current is not None:
-                    path.append(current.get_coordinates())
-                    current = current.parent
-                path = path[::-1]  # Reverse the path so it's from start to exit
-                return path
-
-            closed_list.add(current)
-
-            for neighbor in [current.north, current.south, current.east, current.west]:
-                if neighbor is not None and neighbor not in closed_list:
-                    if neighbor.cellType == "obstacle":
-                        continue
-                    if person_obstacles and neighbor.is_occupied():
-                        continue
-                    tentative_g = current.g + 1
-                    if (
-                        neighbor not in open_set or tentative_g < neighbor.g
-                    ):  # Check if neighbor is in open_set
-                        neighbor.g = tentative_g
-                        neighbor.h = heuristic(
-                            neighbor.get_coordinates(),
-                            find_nearest_exit(
-                                find_exits(grid), neighbor.get_coordinates()
-                            ),
-                        )
-                        neighbor.f = neighbor.g + neighbor.h
-                        neighbor.parent = current  # Set parent
+    def colors(self, ids):
+        # Colour names for the people in ids, following the checks of the drawing legend
+        import numpy as np
+
+        ids = np.asarray(ids, dtype=np.intp)
+        strong = self.view("is_strong")[ids] == 1
+        rational = self.view("is_rational")[ids] == 1
+        codes = np.select(
+            [
+                self.view("is_dead")[ids] == 1,
+                self.view("is_fallen")[ids] == 1,
+                self.view("is_relaxed")[ids] == 1,
+                strong & ~rational,
+                strong & rational,
+                ~strong & ~rational,
+            ],
+            [0, 1, 2, 3, 4, 5],
+            default=6,
+        )
+        return [self.COLORS[code] for code in codes]
+
+    def count(self, name):
+        # Number of active people whose flag `name` is set
+        import numpy as np
+
+        return int(np.count_nonzero(self.view(name)[self.view("active") == 1]))
+
+
+class World:
+    # Everything one simulation owns: its grid, the people on it and its random number
+    # streams. People are stored by id in a dict whose order is the order they act in,
+    # so removing someone is O(1) and separate worlds never share state. Their traits
+    # and status live in self.agents.
+    #
+    # Randomness never comes from the global random module. Every world derives one
+    # independent stream per name in STREAMS from a single master seed, so drawing more
+    # obstacles never shifts who gets placed where, and worlds running side by side (in
+    # threads, processes or an embedding program) stay reproducible.
+    STREAMS = ["layout", "placement", "behaviour"]
+
+    def __init__(self, grid, seed=None):
+        self.grid = grid
+        grid.world = self
+        self.people = {}
+        # Everyone who was ever added, indexed by id, including people who have left
+        self.everyone = []
+        self.agents = AgentStore()
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        # Re-derives every stream from master seed `seed`, or from a fresh one if it is
+        # None. master_seed is kept so an unseeded run can still be reported and
+        # repeated.
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little")
+        self.master_seed = int(seed)
+        self.streams = {}
+        self.entropies = {}
+        self.generators = {}
+        for name in self.STREAMS:
+            self.reseed(name, self.master_seed)
+
+    def reseed(self, name, seed):
+        # Restarts stream `name` alone as seed(seed) would derive it, leaving the other
+        # streams and master_seed as they are. Any integer is a valid seed, but
+        # SeedSequence only takes non-negative entropy, so streams are derived from the
+        # seed mapped onto 64 bits.
+        self.entropies[name] = entropy = int(seed) % 2**64
+        # String seeds are hashed with SHA-512, so these do not depend on PYTHONHASHSEED
+        self.streams[name] = random.Random(f"{entropy}/{name}")
+        self.generators.pop(name, None)
+
+    def rng(self, name):
+        # The random.Random of stream `name`
+        return self.streams[name]
+
+    def generator(self, name):
+        # A NumPy Generator for stream `name`, for drawing many values in one call. It
+        # is seeded from the same seed but is separate from rng(name).
+        import numpy as np
+
+        generator = self.generators.get(name)
+        if generator is None:
+            sequence = np.random.SeedSequence(
+                self.entropies[name], spawn_key=(self.STREAMS.index(name),)
+            )
+            generator = self.generators[name] = np.random.default_rng(sequence)
+        return generator
 
-                        if neighbor not in open_set:  # Check if neighbor is in open_set
-                            heapq.heappush(open_list, (neighbor.f, neighbor))
-                            open_set.add(neighbor)
+    def add(self, person):
+        person.id = self.agents.append()
+        self.people[person.id] = person
+        self.everyone.append(person)
 
-        return None
+    def remove(self, person):
+        del self.people[person.id]
+        self.agents.active[person.id] = 0
+
+    def sort_people(self, key):
+        # Stable, like list.sort, so people with equal keys keep their order from the
+        # last step
+        self.people = {
+            person.id: person for person in sorted(self.people.values(), key=key)
+        }
 
 
 def create_grid(rows, cols, custom_layout=None):
-    grid = [
-        [
-            Cell(
-                "exit"
-                if custom_layout and custom_layout[j][i] == "E"
-                else (
-                    "obstacle"
-                    if custom_layout and custom_layout[j][i] == "X"
-                    else "walkable"
-                )
-            )
-            for j in range(cols)
-        ]
-        for i in range(rows)
-    ]
-    for i in range(rows):
-        for j in range(cols):
-            north = grid[i - 1][j] if i > 0 else None
-            south = grid[i + 1][j] if i < rows - 1 else None
-            east = grid[i][j + 1] if j < cols - 1 else None
-            west = grid[i][j - 1] if j > 0 else None
-            grid[i][j].set_neighbors(north, south, east, west)
-            grid[i][j].x = j
-            grid[i][j].y = i
+    # custom_layout is either a list of row strings ('X' for obstacle, 'E' for exit,
+    # anything else walkable) or the flat array of cell type codes read_layout returns
+    grid = Grid(rows, cols)
+    if custom_layout:
+        if not isinstance(custom_layout, array):
+            if len(custom_layout) != rows or any(
+                len(row) != cols for row in custom_layout
+            ):
+                raise ValueError(f"Layout does not have {rows} rows of {cols} cells")
+            text = "".join(custom_layout).encode("latin-1", "replace")
+            custom_layout = layout_codes(text, strict=False)
+        if len(custom_layout) != rows * cols:
+            raise ValueError(f"Layout does not have {rows} rows of {cols} cells")
+        grid.cell_types[:] = custom_layout
+    World(grid)
     return grid
 
 
+# Folder of the floor plans behind the preset grids
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "layouts")
+# Colours of walkable, obstacle and exit cells in image floor plans, indexed by cell
+# type code
+PLAN_COLORS = [(255, 255, 255), (0, 0, 0), (0, 255, 0)]
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def layout_codes(text, strict=True):
+    # Translates floor plan characters ('0' walkable, 'X' obstacle, 'E' exit) to an
+    # array of cell type codes in one pass. Newlines are dropped. Other characters raise
+    # a ValueError, or count as walkable when not strict.
+    table = bytearray([0 if not strict else 255]) * 256
+    table[ord("0")], table[ord("X")], table[ord("E")] = WALKABLE, OBSTACLE, EXIT
+    codes = text.translate(table, b"\n")
+    bad = codes.find(255)
+    if bad != -1:
+        character = chr(text.replace(b"\n", b"")[bad])
+        raise ValueError(f"Unknown floor plan character {character!r}")
+    return array("b", codes)
+
+
+def read_layout(path):
+    # Reads a floor plan file into (rows, cols, cell type codes) for create_grid. Text
+    # plans have one line of '0'/'X'/'E' per row. PNG plans have one pixel per cell, and
+    # each pixel takes the type whose PLAN_COLORS entry is nearest. Neither goes through
+    # per-row strings, so plans with millions of cells load quickly.
+    with open(path, "rb") as plan_file:
+        data = plan_file.read()
+    if data.startswith(PNG_SIGNATURE):
+        return _read_image_layout(path)
+
+    data = data.replace(b"\r", b"").rstrip(b"\n")
+    if not data.strip():
+        raise ValueError(f"{path}: the layout is empty")
+    cols = data.find(b"\n")
+    if cols == -1:
+        cols = len(data)
+    rows = data.count(b"\n") + 1
+    # Every row is as long as the first exactly when each newline sits cols + 1 bytes
+    # apart
+    if len(data) != rows * (cols + 1) - 1 or data[cols :: cols + 1] != b"\n" * (
+        rows - 1
+    ):
+        raise ValueError(f"{path}: every row must have {cols} cells")
+    return rows, cols, layout_codes(data)
+
+
+def _read_image_layout(path, block_rows=256):
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    rows, cols, _ = pixels.shape
+    palette = np.array(PLAN_COLORS, dtype=np.int32)
+    codes = array("b")
+    # Done a block of rows at a time to bound the size of the distance array
+    for start in range(0, rows, block_rows):
+        block = pixels[start : start + block_rows].astype(np.int32)
+        distances = ((block[:, :, None, :] - palette) ** 2).sum(axis=-1)
+        codes.frombytes(distances.argmin(axis=-1).astype(np.int8).tobytes())
+    return rows, cols, codes
+
+
+def load_layout(path):
+    # A grid, with its World, built from a floor plan file
+    return create_grid(*read_layout(path))
+
+
+# The GridRenderer behind each Axes draw_grid has drawn on
+_renderers = weakref.WeakKeyDictionary()
+
+
 def setup_grid_and_draw(grid):
+    # matplotlib is only imported once something is drawn, so headless runs never load
+    # it
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(10, 8))
     draw_grid(grid, ax)
     plt.ion()
@@ -227,9 +570,26 @@ def setup_grid_and_draw(grid):
     return fig, ax
 
 
-def draw_grid(grid, ax):
-    ax.clear()
-    colorsAndLabels = [
+def draw_grid(grid, ax, show_ids=True):
+    # Draws grid on ax. The first call sets up a GridRenderer for the pair; calls after
+    # that (one per frame in run_simulation) only update what changed since the last
+    # frame.
+    renderer = _renderers.get(ax)
+    if renderer is None or renderer.grid is not grid or renderer.show_ids != show_ids:
+        renderer = _renderers[ax] = GridRenderer(grid, ax, show_ids)
+    else:
+        renderer.update()
+    return renderer
+
+
+class GridRenderer:
+    # Keeps the artists for one grid drawn on one Axes. The floor is a single image,
+    # redrawn only when the layout changes; everyone on the grid is one collection of
+    # circles whose positions and colours are replaced each frame; and id labels are
+    # created once per person and only moved when that person has. The labels are most
+    # of the drawing time for big crowds, so show_ids=False leaves them out.
+    FLOOR_COLORS = ["saddlebrown", "gray", "lime"]  # Indexed by cell type code
+    LEGEND = [
         ("green", "Relaxed"),
         ("lightgrey", "Fallen"),
         ("black", "Dead"),
@@ -239,59 +599,128 @@ def draw_grid(grid, ax):
         ("purple", "Weak, Rational"),
     ]
 
-    legendElements = [
-        patches.Patch(color=color, label=label) for color, label in colorsAndLabels
-    ]
-
-    for i, row in enumerate(grid):
-        for j, cell in enumerate(row):
-            if cell.cellType == "exit":
-                color = "lime"
-                fontsize = 14 if len(grid) < 10 else 4
-                ax.text(
-                    j + 0.5,
-                    -i + 0.5,
-                    "Exit",
-                    ha="center",
-                    va="center",
-                    fontsize=fontsize,
-                )
-
-            elif cell.cellType == "obstacle":
-                color = "gray"
-            else:
-                color = "saddlebrown"
-            ax.add_patch(patches.Rectangle((j, -i), 1, 1, fill=True, color=color))
-            if cell.occupied:
-                person_color = cell.occupied.color()
-                fontsize = 14 if len(grid) < 10 else 4.6
-                ax.add_patch(
-                    patches.Circle((j + 0.5, -(i - 0.5)), 0.4, color=person_color)
-                )
-                ax.text(
-                    j + 0.5,
-                    -(i - 0.5),
-                    cell.occupied.id,
+    def __init__(self, grid, ax, show_ids=True):
+        import numpy as np
+        import matplotlib.patches as patches
+        from matplotlib.collections import EllipseCollection
+
+        self.grid, self.ax, self.show_ids = grid, ax, show_ids
+        ax.clear()
+        self.floor = None
+        self.exit_labels = []
+        self.layout_version = None
+        # Circles of radius 0.4 in data units, centred on each occupied cell
+        self.people = EllipseCollection(
+            widths=0.8,
+            heights=0.8,
+            angles=0,
+            units="xy",
+            offsets=np.zeros((0, 2)),
+            offset_transform=ax.transData,
+            zorder=2,
+        )
+        ax.add_collection(self.people)
+        self.labels = {}  # Person id -> (Text, cell index it was last drawn on)
+        self.label_fontsize = 14 if len(grid) < 10 else 4.6
+
+        ax.set_xlim(0, len(grid[0]) + (len(grid[0]) / 3))
+        ax.set_ylim(-len(grid), 1)
+        ax.set_aspect("equal")
+        ax.axis("off")
+        legendElements = [
+            patches.Patch(color=color, label=label) for color, label in self.LEGEND
+        ]
+        ax.legend(handles=legendElements, loc="upper right", bbox_to_anchor=(1.0, 1.0))
+        self.update()
+
+    def draw_floor(self):
+        import numpy as np
+        from matplotlib.colors import to_rgb
+
+        grid, ax = self.grid, self.ax
+        palette = np.array([to_rgb(color) for color in self.FLOOR_COLORS])
+        cell_types = np.frombuffer(grid.cell_types, dtype=np.int8)
+        image = palette[cell_types].reshape(grid.rows, grid.cols, 3)
+        if self.floor is None:
+            # Row i covers y from -i to 1 - i, as the per-cell rectangles used to
+            self.floor = ax.imshow(
+                image,
+                extent=(0, grid.cols, 1 - grid.rows, 1),
+                interpolation="nearest",
+                zorder=0,
+            )
+        else:
+            self.floor.set_data(image)
+
+        for label in self.exit_labels:
+            label.remove()
+        fontsize = 14 if len(grid) < 10 else 4
+        self.exit_labels = [
+            ax.text(
+                x + 0.5, -y + 0.5, "Exit", ha="center", va="center", fontsize=fontsize
+            )
+            for x, y in find_exits(grid)
+        ]
+        self.layout_version = grid.layout_version
+
+    def update(self):
+        import numpy as np
+
+        grid = self.grid
+        if self.layout_version != grid.layout_version:
+            self.draw_floor()
+
+        occupants = np.frombuffer(grid.occupants, dtype=np.int32)
+        indexes = np.flatnonzero(occupants != EMPTY)
+        ids = occupants[indexes]
+        rows, cols = np.divmod(indexes, grid.cols)
+        self.people.set_offsets(np.column_stack([cols + 0.5, 0.5 - rows]))
+        self.people.set_facecolors(grid.world.agents.colors(ids))
+        if not self.show_ids:
+            return
+
+        current = dict(zip(ids.tolist(), indexes.tolist()))
+        for person_id in list(self.labels):
+            if person_id not in current:
+                self.labels.pop(person_id)[0].remove()
+        for person_id, index in current.items():
+            y, x = divmod(index, grid.cols)
+            if person_id not in self.labels:
+                label = self.ax.text(
+                    x + 0.5,
+                    -(y - 0.5),
+                    person_id,
                     ha="center",
                     va="center",
                     color="white",
-                    fontsize=fontsize,
+                    fontsize=self.label_fontsize,
+                    zorder=3,
                 )
-
-    ax.set_xlim(0, len(grid[0]) + (len(grid[0]) / 3))
-    ax.set_ylim(-len(grid), 1)
-    ax.set_aspect("equal")
-    ax.axis("off")
-    ax.legend(handles=legendElements, loc="upper right", bbox_to_anchor=(1.0, 1.0))
+                self.labels[person_id] = (label, index)
+            elif self.labels[person_id][1] != index:
+                label = self.labels[person_id][0]
+                label.set_position((x + 0.5, -(y - 0.5)))
+                self.labels[person_id] = (label, index)
 
 
 def find_exits(grid):
-    exits = []
-    for row in grid:
-        for cell in row:
-            if cell.cellType == "exit":
-                exits.append(cell.get_coordinates())
-    return exits
+    return [
+        (index % grid.cols, index // grid.cols)
+        for index in find_cell_indexes(grid, "exit")
+    ]
+
+
+def find_cell_indexes(grid, cellType):
+    # Indexes of every cell of the given type, found with bytes.find over the type array
+    # rather than by visiting each cell
+    data = grid.cell_types.tobytes()
+    code = bytes([CELL_TYPE_CODES[cellType]])
+    indexes = []
+    index = data.find(code)
+    while index != -1:
+        indexes.append(index)
+        index = data.find(code, index + 1)
+    return indexes
 
 
 def heuristic(a, b):
@@ -313,245 +742,1672 @@ def find_nearest_exit(exits, start_location):
     return closest_exit
 
 
-def run_simulation(grid, steps=10):
-    fig, ax = setup_grid_and_draw(grid)
-    auto_run = False
+class ExitIndex:
+    # The exits of a grid, found once, plus a lazily filled table of the Manhattan
+    # distance from each cell to its nearest exit. Built through exit_index(grid), which
+    # throws it away as soon as a cellType changes.
+    def __init__(self, grid):
+        self.cols = grid.cols
+        self.exits = find_exits(grid)
+        self.nearest = [None] * (grid.rows * grid.cols)
+
+    def nearest_exit_distance(self, index):
+        distance = self.nearest[index]
+        if distance is None:
+            location = (index % self.cols, index // self.cols)
+            nearest_exit = find_nearest_exit(self.exits, location)
+            distance = (
+                heuristic(location, nearest_exit)
+                if nearest_exit is not None
+                else math.inf
+            )
+            self.nearest[index] = distance
+        return distance
+
+
+def exit_index(grid):
+    return grid.cached("exit_index", ExitIndex)
+
+
+def nearest_exit_distance(grid, cell):
+    # Same value as heuristic(cell, find_nearest_exit(find_exits(grid), cell)) without
+    # rescanning the grid for exits on every call
+    return exit_index(grid).nearest_exit_distance(cell.index)
+
+
+class SearchContext:
+    # Scratch space for A* kept outside the cells, as flat arrays indexed by Cell.index.
+    # Each search gets a new stamp, and a g or parent entry only counts if it carries
+    # the current stamp, so nothing has to be reset between searches. One context must
+    # only be used by one search at a time; find_path keeps one per thread.
+    def __init__(self, size):
+        self.g = [math.inf] * size
+        self.parent = [None] * size
+        self.seen = [0] * size
+        self.closed = [0] * size
+        self.stamp = 0
+        # Running totals over every search, read by StepProfiler
+        self.expansions = 0
+        self.pushes = 0
+
+    def start_search(self):
+        self.stamp += 1
+        return self.stamp
+
+
+_thread_search_contexts = threading.local()
+
+
+def search_context(grid):
+    # The calling thread's SearchContext for grids of this size
+    contexts = getattr(_thread_search_contexts, "contexts", None)
+    if contexts is None:
+        contexts = _thread_search_contexts.contexts = {}
+    size = len(grid.cell_types)
+    if size not in contexts:
+        contexts[size] = SearchContext(size)
+    return contexts[size]
+
+
+def find_path(grid, start, person_obstacles=False, occupied=None, context=None):
+    # A* from start to the nearest exit, returned as a list of coordinates (or None). No
+    # state is written to the grid or its cells, so concurrent calls are safe as long as
+    # each one has its own context. With person_obstacles, occupied cells are avoided;
+    # pass a set of cell indexes as occupied to search against a snapshot instead of the
+    # live occupancy.
+    if context is None:
+        context = search_context(grid)
+    stamp = context.start_search()
+    g, parent, seen, closed = context.g, context.parent, context.seen, context.closed
+    cell_types, occupants, cols = grid.cell_types, grid.occupants, grid.cols
+    exit_heuristic = exit_index(grid).nearest_exit_distance
+
+    g[start.index] = 0
+    parent[start.index] = None
+    seen[start.index] = stamp
+    open_list = [(exit_heuristic(start.index), 0, start.index)]
+    pushes = 1
+    expansions = 0
+
+    while open_list:
+        index = heapq.heappop(open_list)[2]
+        if closed[index] == stamp:
+            continue
+
+        if cell_types[index] == EXIT:
+            path = []
+            while index is not None:
+                path.append((index % cols, index // cols))
+                index = parent[index]
+            path = path[::-1]  # Reverse the path so it's from start to exit
+            context.expansions += expansions
+            context.pushes += pushes
+            return path
+
+        closed[index] = stamp
+        expansions += 1
+        current_g = g[index]
+
+        for neighbor in grid.neighbor_indexes(index):
+            if closed[neighbor] == stamp or cell_types[neighbor] == OBSTACLE:
+                continue
+            if person_obstacles and (
+                neighbor in occupied
+                if occupied is not None
+                else occupants[neighbor] != EMPTY
+            ):
+                continue
+            tentative_g = current_g + 1
+            if seen[neighbor] != stamp or tentative_g < g[neighbor]:
+                seen[neighbor] = stamp
+                g[neighbor] = tentative_g
+                parent[neighbor] = index
+                f = tentative_g + exit_heuristic(neighbor)
+                heapq.heappush(open_list, (f, pushes, neighbor))
+                pushes += 1
+
+    context.expansions += expansions
+    context.pushes += pushes
+    return None
+
+
+def exit_distance_field(grid):
+    # One multi-source BFS from every exit, shared by everyone. distances[cell.index] is
+    # the number of steps from that cell to the closest exit (None if no exit can be
+    # reached). It is only recomputed when a cellType on the grid has changed since the
+    # last call.
+    return grid.cached("exit_distances", _build_exit_distance_field)
+
+
+def _build_exit_distance_field(grid):
+    cell_types = grid.cell_types
+    distances = [None] * len(cell_types)
+    queue = deque(find_cell_indexes(grid, "exit"))
+    for index in queue:
+        distances[index] = 0
+
+    while queue:
+        current = queue.popleft()
+        distance = distances[current] + 1
+        for neighbor in grid.neighbor_indexes(current):
+            if cell_types[neighbor] != OBSTACLE and distances[neighbor] is None:
+                distances[neighbor] = distance
+                queue.append(neighbor)
+
+    return distances
+
+
+class ExitTree:
+    # The shortest-path trees of every exit at once, from one breadth-first search
+    # backwards from all of them, shared by everyone who needs a route. steps[index] is
+    # the number of steps from that cell to the closest exit (None if it cannot reach
+    # one), and a route is read off by stepping to the first neighbor, in N,S,E,W order,
+    # one step closer. Without person_obstacles this is just exit_distance_field; with
+    # it, occupied cells are left out of the search as find_path(...,
+    # person_obstacles=True) avoids them, and the tree only holds for the occupancy it
+    # was built on.
+    def __init__(self, grid, person_obstacles=False):
+        self.grid = grid
+        if not person_obstacles:
+            self.steps = exit_distance_field(grid)
+            return
+
+        self.search()
+
+    def search(self):
+        grid = self.grid
+        cell_types, occupants = grid.cell_types, grid.occupants
+        steps = self.steps = [None] * len(cell_types)
+        queue = deque(
+            index
+            for index in find_cell_indexes(grid, "exit")
+            if occupants[index] == EMPTY
+        )
+        for index in queue:
+            steps[index] = 0
+        while queue:
+            current = queue.popleft()
+            distance = steps[current] + 1
+            for neighbor in grid.neighbor_indexes(current):
+                if (
+                    steps[neighbor] is None
+                    and cell_types[neighbor] != OBSTACLE
+                    and occupants[neighbor] == EMPTY
+                ):
+                    steps[neighbor] = distance
+                    queue.append(neighbor)
+
+    def next_index(self, index):
+        # The cell after index on its route, or EMPTY at an exit
+        steps = self.steps
+        distance = steps[index] - 1
+        if distance < 0:
+            return EMPTY
+        for neighbor in self.grid.neighbor_indexes(index):
+            if steps[neighbor] == distance:
+                return neighbor
+
+    def path(self, start):
+        return _field_path(self, start, self.steps)
+
+
+def path_from_distance_field(grid, start):
+    # Follows the gradient of the exit distance field down to an exit. Returns the same
+    # kind of path as Person.a_star(grid, start, False), a shortest route from start to
+    # an exit or None if no exit can be reached, as a FieldPath on the grid's shared
+    # ExitTree.
+    return grid.cached("exit_tree", ExitTree).path(start)
+
+
+class OccupancyChanges:
+    # What changed in a grid's occupancy between two calls to update(): flipped marks
+    # the cells that went from empty to taken or back, and count(box) says how many of
+    # them lie in a box in O(1) through a summed-area table. The first update() finds no
+    # changes. version is an occupancy version number, bumped by every update() that
+    # found some.
+    def __init__(self, grid):
+        self.grid = grid
+        self.taken = None
+        self.flipped = None
+        self.table = None
+        self.version = 0
+
+    def update(self):
+        # Returns whether anything changed since the last call
+        import numpy as np
+
+        grid = self.grid
+        taken = np.frombuffer(grid.occupants, dtype=np.int32) != EMPTY
+        if self.taken is None:
+            flipped = np.zeros(len(taken), dtype=bool)
+        else:
+            flipped = taken != self.taken
+        # table[i][j] is the number of flipped cells above and to the left of (i, j)
+        table = np.zeros((grid.rows + 1, grid.cols + 1), dtype=np.int64)
+        table[1:, 1:] = flipped.reshape(grid.rows, grid.cols).cumsum(0).cumsum(1)
+        self.taken, self.flipped, self.table = taken, flipped, table.tolist()
+        changed = bool(table[-1, -1])
+        self.version += changed
+        return changed
+
+    def count(self, box):
+        top, left, bottom, right = box
+        above, below = self.table[top], self.table[bottom + 1]
+        return below[right + 1] - above[right + 1] - below[left] + above[left]
+
+
+def _search_box(grid, start, path, expansions):
+    # The (top, left, bottom, right) box holding every cell whose occupancy a find_path
+    # search from start with person_obstacles read, given the path it returned and the
+    # number of cells it expanded. Every expanded cell is at most `radius` - 1 steps
+    # from the start: a path's length bounds the f, and so the g, of everything expanded
+    # before it, and a failed search cannot get further away than the number of cells it
+    # expanded. The extra step covers the neighbours it read.
+    radius = len(path) if path is not None else expansions
+    y, x = divmod(start, grid.cols)
+    return (
+        max(y - radius, 0),
+        max(x - radius, 0),
+        min(y + radius, grid.rows - 1),
+        min(x + radius, grid.cols - 1),
+    )
+
+
+class ActiveSet:
+    # Skips the pathfinding of everyone whose surroundings did not change since the last
+    # step. The path ignoring others only depends on the layout and where a person
+    # stands. A* only reads the occupancy of cells within its _search_box, so a person
+    # who has not moved gets the same path around others again as long as no cell in
+    # that box went from empty to taken or back. refresh() finds the cells that did,
+    # once per step, and paths() checks a person's box against them. A route is only
+    # reused if it was found or reused on the step just before, so nobody misses a
+    # change made while they were down. Kept in the grid's layout cache, so no route
+    # outlives a change of cellType.
+    def __init__(self, grid):
+        self.grid = grid
+        self.changes = OccupancyChanges(grid)
+        self.generation = 0
+        # person id -> [start index, (top, left, bottom, right), paths, generation]
+        self.routes = {}
+        self.reused = 0
+
+    def refresh(self):
+        self.changes.update()
+        for person_id in [
+            person_id
+            for person_id, route in self.routes.items()
+            if route[3] != self.generation
+        ]:
+            del self.routes[person_id]
+        self.generation += 1
+
+    def paths(self, person):
+        # (path with obstacles, path without obstacles) of person, as find_paths wants
+        # them
+        start = person.location.index
+        route = self.routes.get(person.id)
+        if route is not None and route[0] == start:
+            route[3] = self.generation
+            if self.changes.count(route[1]) == 0:
+                self.reused += 1
+                return route[2]
+            path_without_obstacles = route[2][1]
+        else:
+            path_without_obstacles = path_from_distance_field(
+                self.grid, person.location
+            )
 
-    print("\nRunning simulation...")
-    try:
-        for _ in range(steps + 1):
-            if _ != 0:
+        grid = self.grid
+        context = search_context(grid)
+        expansions = context.expansions
+        path = find_path(grid, person.location, True, context=context)
+        box = _search_box(grid, start, path, context.expansions - expansions)
+        paths = (path, path_without_obstacles)
+        self.routes[person.id] = [start, box, paths, self.generation]
+        return paths
+
+
+PATH_CACHE_SIZE = 4096
+
+
+class PathCache:
+    # A bounded LRU cache of routes around other people by start cell, behind the
+    # "cached" pathfinding mode. refresh(), once per step, drops every entry with a
+    # changed cell in its _search_box. An entry whose first step was just taken moves on
+    # to its next cell instead, as the rest of a shortest route is still a shortest
+    # route, though A* may break ties differently. hits, misses and suffixes (entries
+    # moved on like that) are running totals, for tuning maxsize.
+    def __init__(self, grid, maxsize=PATH_CACHE_SIZE):
+        self.grid = grid
+        self.maxsize = maxsize
+        self.changes = OccupancyChanges(grid)
+        self.entries = OrderedDict()  # start index -> (box, path)
+        self.hits = 0
+        self.misses = 0
+        self.suffixes = 0
+
+    def refresh(self):
+        changes = self.changes
+        if not changes.update():
+            return
+        flipped, taken, cols = changes.flipped, changes.taken, self.grid.cols
+        entries = OrderedDict()
+        for start, (box, path) in self.entries.items():
+            changed = changes.count(box)
+            if changed == 0:
+                entries[start] = (box, path)
+            elif changed == 2 and path is not None and len(path) > 2:
+                x, y = path[1]
+                after = y * cols + x
+                if (
+                    flipped[start]
+                    and flipped[after]
+                    and taken[after]
+                    and not taken[start]
+                ):
+                    # The box still bounds every shorter route from the next cell
+                    entries[after] = (box, path[1:])
+                    self.suffixes += 1
+        self.entries = entries
+
+    def path(self, start):
+        # The route around others from the Cell start, as find_path(grid, start, True)
+        # finds it
+        entry = self.entries.get(start.index)
+        if entry is not None:
+            self.entries.move_to_end(start.index)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        grid = self.grid
+        context = search_context(grid)
+        expansions = context.expansions
+        path = find_path(grid, start, True, context=context)
+        box = _search_box(grid, start.index, path, context.expansions - expansions)
+        self.entries[start.index] = (box, path)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return path
+
+
+class IncrementalExitTree(ExitTree):
+    # ExitTree(grid, person_obstacles=True) kept up to date between steps instead of
+    # rebuilt, in the LPA* style: refresh() compares the occupancy with the last call's
+    # and repairs only the cells whose distance to an exit changed. Everyone reads their
+    # route off this one tree, so routes are the same as with a fresh ExitTree. When
+    # too much changed for a repair to pay off, it searches again from scratch. Kept in
+    # the grid's layout cache, so it starts over whenever a cellType changes. expansions
+    # counts the cells given a distance, by repairs and searches alike.
+    def __init__(self, grid):
+        self.expansions = 0
+        super().__init__(grid, person_obstacles=True)
+        self.taken = self.occupancy()
+
+    def occupancy(self):
+        import numpy as np
+
+        return np.frombuffer(self.grid.occupants, dtype=np.int32) != EMPTY
+
+    def search(self):
+        super().search()
+        self.expansions += len(self.steps) - self.steps.count(None)
+
+    def refresh(self):
+        import numpy as np
+
+        taken = self.occupancy()
+        changed = np.flatnonzero(taken != self.taken)
+        self.taken = taken
+        if not len(changed):
+            return
+        # Every flipped cell tends to shift the distances of a line of cells behind it,
+        # so with many of them a fresh search is cheaper than even trying to repair
+        reached = len(self.steps) - self.steps.count(None)
+        if len(changed) * 8 > reached or not self.repair(
+            changed[taken[changed]].tolist(), changed[~taken[changed]].tolist(), reached
+        ):
+            self.search()
+
+    def repair(self, now_taken, freed, reached):
+        # Returns False, leaving steps half repaired, once the work passes a third of
+        # the reached cells
+        grid = self.grid
+        steps, cell_types, occupants = self.steps, grid.cell_types, grid.occupants
+        neighbor_indexes = grid.neighbor_indexes
+        budget = reached // 3
+
+        # Distances only grow when cells are taken: clear every cell that no longer has
+        # a neighbor one step closer to an exit, and then the cells that relied on it
+        queue = deque()
+        for index in now_taken:
+            if steps[index] is not None:
+                queue.append((index, steps[index]))
+                steps[index] = None
+        orphans = []
+        while queue:
+            index, distance = queue.popleft()
+            for neighbor in neighbor_indexes(index):
+                if steps[neighbor] == distance + 1 and distance not in [
+                    steps[other] for other in neighbor_indexes(neighbor)
+                ]:
+                    steps[neighbor] = None
+                    orphans.append(neighbor)
+                    queue.append((neighbor, distance + 1))
+            if len(orphans) > budget:
+                return False
+
+        # Then the cleared and freed cells take their distance from their neighbors,
+        # spreading out from there to every cell it shortens the way for
+        heap = []
+        for index in orphans + freed:
+            if cell_types[index] == EXIT:
+                heap.append((0, index))
+            elif cell_types[index] != OBSTACLE:
+                known = [
+                    steps[neighbor]
+                    for neighbor in neighbor_indexes(index)
+                    if steps[neighbor] is not None
+                ]
+                if known:
+                    heap.append((min(known) + 1, index))
+        heapq.heapify(heap)
+        work = len(orphans)
+        while heap:
+            distance, index = heapq.heappop(heap)
+            if steps[index] is not None and steps[index] <= distance:
+                continue
+            steps[index] = distance
+            self.expansions += 1
+            work += 1
+            if work > budget:
+                return False
+            for neighbor in neighbor_indexes(index):
+                if (
+                    (steps[neighbor] is None or steps[neighbor] > distance + 1)
+                    and cell_types[neighbor] != OBSTACLE
+                    and occupants[neighbor] == EMPTY
+                ):
+                    heapq.heappush(heap, (distance + 1, neighbor))
+        return True
+
+
+class PathHierarchy:
+    # HPA*-style abstraction of a grid's layout for very large venues. The grid is cut
+    # into cluster_size x cluster_size clusters. Wherever two neighboring clusters share
+    # a run of open border cells, pairs of cells across the border every `spacing` cells
+    # along the run (and at its far end) become transitions between them, or just the
+    # middle pair for runs shorter than that. Transition and exit cells are the nodes of
+    # an abstract graph whose edges are a single step across a border or the shortest
+    # route between two nodes of the same cluster, and one Dijkstra pass over that graph
+    # from the exits gives every node its distance to the nearest exit. A query then
+    # only searches the start's cluster and follows the abstract graph from there.
+    # Routes found this way are not always the shortest ones, but seldom by much. When
+    # cells change type, only the clusters they are in and their neighbors are rebuilt,
+    # and only the nodes whose way to an exit ran through those are solved again. The
+    # first build is pure Python and takes about 7 s for 500x500 cells and 25 s for
+    # 1000x1000; a rebuild after one cell changes then takes under 0.2 s at either
+    # size. Use hierarchy(grid), which keeps one per grid and brings it up to date.
+    def __init__(self, grid, cluster_size=16, spacing=3):
+        self.grid, self.size, self.spacing = grid, cluster_size, spacing
+        self.cluster_rows = -(-grid.rows // cluster_size)
+        self.cluster_cols = -(-grid.cols // cluster_size)
+        # Transitions as (cell, cell) pairs, on each cluster's east and south border
+        self.east, self.south = {}, {}
+        # Each cluster's nodes, and its edges as node -> [(other node, steps), ...]
+        self.nodes, self.edges = {}, {}
+        # node -> the nodes one step away across a cluster border
+        self.crossings = {}
+        # Each node's steps to the nearest exit and the next node on the way there
+        self.exit_steps, self.next_node = {}, {}
+        self.cell_types = array("b", grid.cell_types)
+        self.layout_version = grid.layout_version
+        self.rebuild(range(self.cluster_rows * self.cluster_cols))
+
+    def cluster_of(self, index):
+        y, x = divmod(index, self.grid.cols)
+        return (y // self.size) * self.cluster_cols + x // self.size
+
+    def bounds(self, cluster):
+        cy, cx = divmod(cluster, self.cluster_cols)
+        y0, x0 = cy * self.size, cx * self.size
+        return (
+            y0,
+            min(y0 + self.size, self.grid.rows),
+            x0,
+            min(x0 + self.size, self.grid.cols),
+        )
 
-                # PATHFINDING LOGIC
-                paths = {}
-                for person in Person.all_people:
-                    if not person.isDead and not person.isFallen:
-                        start_location = person.location.get_coordinates()
-                        path_without_obstacles = person.a_star(
-                            grid, person.location, False
-                        )
-                        path_with_obstacles = person.a_star(grid, person.location, True)
+    def neighbor_clusters(self, cluster):
+        cy, cx = divmod(cluster, self.cluster_cols)
+        return [
+            cluster + dy * self.cluster_cols + dx
+            for dy, dx in ((-1, 0), (1, 0), (0, 1), (0, -1))
+            if 0 <= cy + dy < self.cluster_rows and 0 <= cx + dx < self.cluster_cols
+        ]
 
-                        paths[person] = (path_with_obstacles, path_without_obstacles)
+    def refresh(self):
+        # Rebuilds the clusters whose cells changed type since the last call
+        import numpy as np
+
+        grid = self.grid
+        if grid.layout_version == self.layout_version:
+            return
+        changed = np.flatnonzero(
+            np.frombuffer(grid.cell_types, dtype=np.int8)
+            != np.frombuffer(self.cell_types, dtype=np.int8)
+        ).tolist()
+        self.cell_types = array("b", grid.cell_types)
+        self.layout_version = grid.layout_version
+        if changed:
+            self.rebuild({self.cluster_of(index) for index in changed})
+
+    def rebuild(self, dirty):
+        cols = self.grid.cols
+        for cluster in dirty:
+            cy, cx = divmod(cluster, self.cluster_cols)
+            y0, y1, x0, x1 = self.bounds(cluster)
+            if cx + 1 < self.cluster_cols:
+                self.set_border(
+                    self.east, cluster, [y * cols + x1 - 1 for y in range(y0, y1)], 1
+                )
+            if cy + 1 < self.cluster_rows:
+                self.set_border(
+                    self.south,
+                    cluster,
+                    [(y1 - 1) * cols + x for x in range(x0, x1)],
+                    cols,
+                )
+            # The borders this cluster shares with its west and north neighbors
+            if cx > 0:
+                self.set_border(
+                    self.east,
+                    cluster - 1,
+                    [y * cols + x0 - 1 for y in range(y0, y1)],
+                    1,
+                )
+            if cy > 0:
+                self.set_border(
+                    self.south,
+                    cluster - self.cluster_cols,
+                    [(y0 - 1) * cols + x for x in range(x0, x1)],
+                    cols,
+                )
 
-                if person.location == "exit":
-                    Person.all_people.remove(person)
+        affected = set(dirty)
+        for cluster in dirty:
+            affected.update(self.neighbor_clusters(cluster))
+        # The nodes whose edges may have changed, before and after the rebuild
+        stale = set()
+        for cluster in affected:
+            stale.update(self.nodes.get(cluster, ()))
+            self.build_cluster(cluster)
+            stale.update(self.nodes[cluster])
+        self.solve(stale)
+
+    def set_border(self, borders, cluster, border, offset):
+        crossings = self.crossings
+        for a, b in borders.get(cluster, ()):
+            crossings[a].remove(b)
+            crossings[b].remove(a)
+        borders[cluster] = self.transitions(border, offset)
+        for a, b in borders[cluster]:
+            crossings.setdefault(a, []).append(b)
+            crossings.setdefault(b, []).append(a)
+
+    def transitions(self, border, offset):
+        # Transitions across a border from the cells in border to the cells offset past
+        # them
+        cell_types = self.grid.cell_types
+        pairs, run = [], []
+        for index in border + [None]:
+            if (
+                index is not None
+                and cell_types[index] != OBSTACLE != cell_types[index + offset]
+            ):
+                run.append(index)
+                continue
+            if run:
+                if len(run) < self.spacing:
+                    picks = [run[len(run) // 2]]
+                else:
+                    picks = run[:: self.spacing]
+                    if picks[-1] != run[-1]:
+                        picks.append(run[-1])
+                pairs.extend((cell, cell + offset) for cell in picks)
+                run = []
+        return pairs
+
+    def build_cluster(self, cluster):
+        # The cluster's nodes (its ends of every transition, plus its exits) and the
+        # shortest routes between them that stay inside the cluster
+        cy, cx = divmod(cluster, self.cluster_cols)
+        nodes = set()
+        nodes.update(a for a, _ in self.east.get(cluster, ()))
+        nodes.update(a for a, _ in self.south.get(cluster, ()))
+        if cx > 0:
+            nodes.update(b for _, b in self.east.get(cluster - 1, ()))
+        if cy > 0:
+            nodes.update(b for _, b in self.south.get(cluster - self.cluster_cols, ()))
+        cols, cell_types = self.grid.cols, self.grid.cell_types
+        y0, y1, x0, x1 = self.bounds(cluster)
+        for y in range(y0, y1):
+            row = cell_types[y * cols + x0 : y * cols + x1]
+            nodes.update(
+                y * cols + x0 + x for x, code in enumerate(row) if code == EXIT
+            )
+        nodes = self.nodes[cluster] = sorted(nodes)
+
+        edges = self.edges[cluster] = {}
+        for node in nodes:
+            distances, _ = self.search(cluster, node)
+            edges[node] = [
+                (other, distances[other])
+                for other in nodes
+                if other != node and other in distances
+            ]
+
+    def search(self, cluster, start, person_obstacles=False):
+        # BFS from start that stays inside cluster. Returns the distance and the
+        # previous cell of every cell reached.
+        grid = self.grid
+        cols, cell_types, occupants = grid.cols, grid.cell_types, grid.occupants
+        y0, y1, x0, x1 = self.bounds(cluster)
+        distances, parents = {start: 0}, {start: None}
+        queue = deque([start])
+        while queue:
+            index = queue.popleft()
+            y, x = divmod(index, cols)
+            distance = distances[index] + 1
+            for neighbor, inside in (
+                (index - cols, y > y0),
+                (index + cols, y < y1 - 1),
+                (index + 1, x < x1 - 1),
+                (index - 1, x > x0),
+            ):
+                if (
+                    inside
+                    and neighbor not in distances
+                    and cell_types[neighbor] != OBSTACLE
+                    and not (person_obstacles and occupants[neighbor] != EMPTY)
+                ):
+                    distances[neighbor] = distance
+                    parents[neighbor] = index
+                    queue.append(neighbor)
+        return distances, parents
+
+    def neighbors(self, node):
+        # (other node, steps) for every edge of node
+        edges = self.edges[self.cluster_of(node)][node]
+        return edges + [(other, 1) for other in self.crossings.get(node, ())]
+
+    def solve(self, stale):
+        # Dijkstra over the abstract graph from every exit, for exit_steps and
+        # next_node. Only the stale nodes and the nodes whose way to an exit led through
+        # one of them start over; the rest keep their route unless it gets shorter.
+        exit_steps, next_node = self.exit_steps, self.next_node
+        children = {}
+        for node, parent in next_node.items():
+            children.setdefault(parent, []).append(node)
+        reset, queue = set(stale), list(stale)
+        while queue:
+            for child in children.get(queue.pop(), ()):
+                if child not in reset:
+                    reset.add(child)
+                    queue.append(child)
+        for node in reset:
+            exit_steps.pop(node, None)
+            next_node.pop(node, None)
+
+        cell_types = self.grid.cell_types
+        open_list = []
+        for node in reset:
+            if node not in self.edges[self.cluster_of(node)]:
+                continue  # No longer a node
+            if cell_types[node] == EXIT:
+                open_list.append((0, node, None))
+                continue
+            known = [
+                (exit_steps[other] + cost, other)
+                for other, cost in self.neighbors(node)
+                if other in exit_steps
+            ]
+            if known:
+                steps, other = min(known)
+                open_list.append((steps, node, other))
+        heapq.heapify(open_list)
+        best = {node: steps for steps, node, _ in open_list}
+        while open_list:
+            steps, node, next_step = heapq.heappop(open_list)
+            if exit_steps.get(node, math.inf) <= steps:
+                continue
+            exit_steps[node] = steps
+            next_node[node] = next_step
+            for other, cost in self.neighbors(node):
+                if steps + cost < best.get(other, exit_steps.get(other, math.inf)):
+                    best[other] = steps + cost
+                    heapq.heappush(open_list, (steps + cost, other, node))
+
+    def path(self, start, person_obstacles=False):
+        # A route from start to an exit as a HierarchicalPath, or None. Only the part
+        # inside start's cluster is searched for here, around other people if
+        # person_obstacles is set; the rest follows the layout alone and is filled in as
+        # it is read.
+        index = start.index
+        if self.grid.cell_types[index] == EXIT:
+            return HierarchicalPath(self, [index], 1)
+        cluster = self.cluster_of(index)
+        distances, parents = self.search(cluster, index, person_obstacles)
+        best = None
+        for node in self.nodes[cluster]:
+            if node in distances and node in self.exit_steps:
+                steps = distances[node] + self.exit_steps[node]
+                if best is None or steps < best[0]:
+                    best = (steps, node)
+        if best is None:
+            return None
+        steps, node = best
+        cells = []
+        while node is not None:
+            cells.append(node)
+            node = parents[node]
+        return HierarchicalPath(self, cells[::-1], steps + 1)
+
+
+class HierarchicalPath:
+    # A path from PathHierarchy.path: behaves like the coordinate list find_path
+    # returns, with the cells after the first leg only worked out, one abstract edge at
+    # a time, once read
+    __slots__ = ("hierarchy", "cells", "length")
+
+    def __init__(self, hierarchy, cells, length):
+        self.hierarchy, self.cells, self.length = hierarchy, cells, length
+
+    def __len__(self):
+        return self.length
+
+    def refine(self):
+        # Adds the cells of the next abstract edge
+        hierarchy, cells = self.hierarchy, self.cells
+        node = cells[-1]
+        next_node = hierarchy.next_node[node]
+        cluster = hierarchy.cluster_of(node)
+        if hierarchy.cluster_of(next_node) != cluster:
+            cells.append(next_node)
+            return
+        _, parents = hierarchy.search(cluster, node)
+        leg = []
+        while next_node != node:
+            leg.append(next_node)
+            next_node = parents[next_node]
+        cells.extend(reversed(leg))
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.length
+        if not 0 <= position < self.length:
+            raise IndexError("path index out of range")
+        while len(self.cells) <= position:
+            self.refine()
+        index = self.cells[position]
+        return (index % self.hierarchy.grid.cols, index // self.hierarchy.grid.cols)
+
+    def __iter__(self):
+        for position in range(self.length):
+            yield self[position]
+
+
+# The PathHierarchy of each grid that has been asked for one
+_hierarchies = weakref.WeakKeyDictionary()
+
+
+def hierarchy(grid):
+    # grid's PathHierarchy, built on first use and afterwards only rebuilt around cells
+    # whose type changed
+    path_hierarchy = _hierarchies.get(grid)
+    if path_hierarchy is None:
+        path_hierarchy = _hierarchies[grid] = PathHierarchy(grid)
+    else:
+        path_hierarchy.refresh()
+    return path_hierarchy
+
+
+class CongestionField:
+    # A congestion-aware flow field for one step: a single Dijkstra pass from every exit
+    # over the occupancy at the time it is built. Stepping into a cell costs 1, plus
+    # occupied_penalty if someone is standing there or fallen_penalty if the person
+    # there is fallen or dead. Each reachable cell keeps the neighbor it should step to
+    # next (the first, in N,S,E,W order, on a cheapest route) and the number of steps
+    # left along that route.
+    def __init__(self, grid, occupied_penalty=3, fallen_penalty=9):
+        self.grid = grid
+        cell_types = grid.cell_types
+        agents = grid.world.agents
+        costs = [1] * len(cell_types)
+        for person in grid.world.people.values():
+            person_id = person.id
+            if agents.is_fallen[person_id] or agents.is_dead[person_id]:
+                costs[person.location.index] += fallen_penalty
+            else:
+                costs[person.location.index] += occupied_penalty
+        self.costs = costs
+
+        distances = self.distances = [None] * len(cell_types)
+        next_indexes = self.next_indexes = [EMPTY] * len(cell_types)
+        steps = self.steps = [0] * len(cell_types)
+        best = [math.inf] * len(cell_types)
+        open_list = [(0, index) for index in find_cell_indexes(grid, "exit")]
+        heapq.heapify(open_list)
+        while open_list:
+            distance, index = heapq.heappop(open_list)
+            if distances[index] is not None:
+                continue
+            distances[index] = distance
+            if cell_types[index] != EXIT:
+                # Every neighbor on a cheapest route is closer to an exit, so it is
+                # settled already
+                for neighbor in grid.neighbor_indexes(index):
+                    if (
+                        distances[neighbor] is not None
+                        and distances[neighbor] + costs[neighbor] == distance
+                    ):
+                        next_indexes[index] = neighbor
+                        steps[index] = steps[neighbor] + 1
+                        break
+            # Reaching this cell from a neighbor means paying to step into it
+            through = distance + costs[index]
+            for neighbor in grid.neighbor_indexes(index):
+                if (
+                    distances[neighbor] is None
+                    and cell_types[neighbor] != OBSTACLE
+                    and through < best[neighbor]
+                ):
+                    best[neighbor] = through
+                    heapq.heappush(open_list, (through, neighbor))
+        # What a route costs from stepping into each cell on
+        self.entry_costs = [
+            None if distance is None else distance + cost
+            for distance, cost in zip(distances, costs)
+        ]
 
-                Person.all_people.sort(
-                    key=lambda person: heuristic(
-                        person.location.get_coordinates(),
-                        find_nearest_exit(
-                            find_exits(grid), person.location.get_coordinates()
-                        ),
-                    )
+    def next_index(self, index):
+        # The cell after index on its route, or EMPTY at an exit
+        return self.next_indexes[index]
+
+    def path(self, start):
+        return _field_path(self, start, self.entry_costs)
+
+
+def _field_path(field, start, costs):
+    # The route from start to an exit on a CongestionField or ExitTree as a FieldPath,
+    # or None if no exit can be reached. The first step is to the neighbor with the
+    # lowest cost (None where the field never got to), so starts the field never
+    # entered (an occupied cell, or someone standing on an obstacle) still get a route.
+    if field.grid.cell_types[start.index] == EXIT:
+        return FieldPath(field, start.index, EMPTY, 1)
+    best, first = math.inf, EMPTY
+    for neighbor in field.grid.neighbor_indexes(start.index):
+        if costs[neighbor] is not None and costs[neighbor] < best:
+            best, first = costs[neighbor], neighbor
+    if first == EMPTY:
+        return None
+    return FieldPath(field, start.index, first, field.steps[first] + 2)
+
+
+class FieldPath:
+    # A path read off a CongestionField or ExitTree: behaves like the coordinate list
+    # find_path returns (len, indexing, slicing and iteration), but cells past the first
+    # step are only walked when asked for
+    __slots__ = ("field", "start", "first", "length")
+
+    def __init__(self, field, start, first, length):
+        self.field, self.start, self.first, self.length = field, start, first, length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        cols = self.field.grid.cols
+        index = self.start
+        yield (index % cols, index // cols)
+        index = self.first
+        while index != EMPTY:
+            yield (index % cols, index // cols)
+            index = self.field.next_index(index)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, stride = position.indices(self.length)
+            if stride < 0:
+                return list(self)[position]
+            return list(itertools.islice(self, start, stop, stride))
+        if position < 0:
+            position += self.length
+        if not 0 <= position < self.length:
+            raise IndexError("path index out of range")
+        for coordinates in self:
+            if position == 0:
+                return coordinates
+            position -= 1
+
+
+class PathHead:
+    # The length and first two cells of a path found in a PathfindingPool worker. Stands
+    # in for the full coordinate list, as moving a person only ever looks at those.
+    __slots__ = ("length", "cells")
+
+    def __init__(self, length, cells):
+        self.length, self.cells = length, cells
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.length
+        if not 0 <= position < len(self.cells):
+            raise IndexError("only the first two cells of a PathHead are known")
+        return self.cells[position]
+
+
+class PathfindingPool:
+    # Spreads step()'s per-person pathfinding over worker processes for big crowds on
+    # big grids. Every step the grid's cell types and occupancy are copied into shared
+    # memory, which every worker reads through its own Grid. The people standing on the
+    # grid are split, in cell order, into strips of rows holding about the same number
+    # of people, and each strip is searched by one worker against that snapshot. Paths
+    # cross strip borders freely, because every worker sees the whole grid. Only the
+    # length and first two cells of each path come back, and movement is settled in the
+    # main process in world order as usual, so the results are the same for any number
+    # of workers.
+    def __init__(self, grid, workers=None, strips_per_worker=4):
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import shared_memory
+
+        size = grid.rows * grid.cols
+        workers = workers or os.cpu_count()
+        self.cell_types = shared_memory.SharedMemory(create=True, size=size)
+        self.occupants = shared_memory.SharedMemory(create=True, size=4 * size)
+        self.executor = ProcessPoolExecutor(
+            workers,
+            initializer=_attach_pool_worker,
+            initargs=(self.cell_types.name, self.occupants.name, grid.rows, grid.cols),
+        )
+        self.strips = workers * strips_per_worker
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def find_paths(self, grid):
+        # The same paths step() would find for everyone standing, as PathHeads
+        size = grid.rows * grid.cols
+        self.cell_types.buf[:size] = memoryview(grid.cell_types).cast("B")
+        self.occupants.buf[: 4 * size] = memoryview(grid.occupants).cast("B")
+
+        standing = sorted(
+            (
+                person
+                for person in grid.world.people.values()
+                if not person.isDead and not person.isFallen
+            ),
+            key=lambda person: person.location.index,
+        )
+        strip_size = -(-len(standing) // self.strips) or 1
+        strips = [
+            standing[start : start + strip_size]
+            for start in range(0, len(standing), strip_size)
+        ]
+        results = self.executor.map(
+            _find_strip_paths,
+            [grid.layout_version] * len(strips),
+            [[person.location.index for person in strip] for strip in strips],
+        )
+        paths = {}
+        for strip, strip_paths in zip(strips, results):
+            for person, (path_with_obstacles, path_without_obstacles) in zip(
+                strip, strip_paths
+            ):
+                paths[person] = (
+                    path_with_obstacles and PathHead(*path_with_obstacles),
+                    path_without_obstacles and PathHead(*path_without_obstacles),
                 )
+        return paths
+
+    def close(self):
+        self.executor.shutdown()
+        for memory in (self.cell_types, self.occupants):
+            memory.close()
+            memory.unlink()
+
+
+# The Grid a PathfindingPool worker process searches, backed by the pool's shared memory
+_pool_worker = {}
+
+
+def _attach_pool_worker(cell_types_name, occupants_name, rows, cols):
+    from multiprocessing import shared_memory
+
+    size = rows * cols
+    cell_types = shared_memory.SharedMemory(name=cell_types_name)
+    occupants = shared_memory.SharedMemory(name=occupants_name)
+    grid = Grid(rows, cols)
+    grid.cell_types = cell_types.buf[:size].cast("b")
+    grid.occupants = occupants.buf[: 4 * size].cast("i")
+    _pool_worker.update(grid=grid, memory=(cell_types, occupants))
+
+
+def _find_strip_paths(layout_version, indexes):
+    grid = _pool_worker["grid"]
+    if grid.layout_version != layout_version:
+        # The layout in shared memory changed, so everything cached from it is stale
+        grid.layout_cache.clear()
+        grid.layout_version = layout_version
+    results = []
+    for index in indexes:
+        start = grid.cell(index)
+        heads = []
+        for path in (
+            find_path(grid, start, True),
+            path_from_distance_field(grid, start),
+        ):
+            heads.append(path and (len(path), tuple(path[:2])))
+        results.append(heads)
+    return results
+
+
+class StepProfiler:
+    # Instrumentation for step() and the functions that run it. Every step gets a row
+    # with the wall time of each phase (pathfinding, sorting, movement, status, and
+    # drawing when a frame is drawn) and counters: A* node expansions and heap pushes in
+    # this process, moves, and conflicts (people with somewhere to go who stayed where
+    # they were), plus PathCache hits and misses with "cached" pathfinding. Drawing the
+    # initial state goes into a row for step 0. hooks are called as hook(grid, phase,
+    # seconds) after every phase, e.g. to feed live metrics. write() saves the table as
+    # CSV or JSON.
+    PHASES = ["pathfinding", "sorting", "movement", "status", "drawing"]
+    COUNTERS = [
+        "expansions",
+        "heap_pushes",
+        "moves",
+        "conflicts",
+        "people",
+        "cache_hits",
+        "cache_misses",
+    ]
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.rows = []
+
+    def begin_step(self):
+        step_number = self.rows[-1]["step"] + 1 if self.rows else 1
+        self.rows.append(dict.fromkeys(["step"] + self.PHASES + self.COUNTERS, 0))
+        self.rows[-1]["step"] = step_number
+
+    @contextlib.contextmanager
+    def phase(self, grid, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if not self.rows:
+                self.rows.append(
+                    dict.fromkeys(["step"] + self.PHASES + self.COUNTERS, 0)
+                )
+            self.rows[-1][name] += seconds
+            for hook in self.hooks:
+                hook(grid, name, seconds)
+
+    def count(self, **counters):
+        row = self.rows[-1]
+        for name, amount in counters.items():
+            row[name] += amount
+
+    def totals(self):
+        # Every phase and counter summed over the run
+        return {
+            name: sum(row[name] for row in self.rows)
+            for name in self.PHASES + self.COUNTERS
+        }
+
+    def write(self, path):
+        # The per-step table as JSON (a list of rows) if path ends in .json, CSV
+        # otherwise. Times are in seconds; total is the sum of the phases.
+        rows = [
+            dict(row, total=sum(row[name] for name in self.PHASES)) for row in self.rows
+        ]
+        with open(path, "w", newline="") as table_file:
+            if path.lower().endswith(".json"):
+                json.dump(rows, table_file, indent=1)
+            else:
+                import csv
+
+                columns = ["step"] + self.PHASES + ["total"] + self.COUNTERS
+                writer = csv.DictWriter(table_file, columns)
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+def _untimed(grid, name):
+    return contextlib.nullcontext()
+
+
+def profile_call(func, *args, tool="cprofile", output=None, **kwargs):
+    # Runs func(*args, **kwargs) under cProfile, or pyinstrument if tool is
+    # "pyinstrument" (it has to be installed), and prints where the time went to stderr.
+    # output also saves cProfile's raw stats there for other viewers. Returns what func
+    # returned.
+    if tool == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+            print(profiler.output_text(), file=sys.stderr)
+
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(
+            25
+        )
+        if output:
+            profile.dump_stats(output)
+
+
+PATHFINDING_MODES = (
+    "a_star",
+    "flow_field",
+    "shared",
+    "cached",
+    "incremental",
+    "hierarchical",
+)
+
+
+def _check_pathfinding(pathfinding, pooled):
+    if pathfinding not in PATHFINDING_MODES:
+        raise ValueError(f"Unknown pathfinding mode: {pathfinding}")
+    if pooled and pathfinding != "a_star":
+        raise ValueError("A PathfindingPool only runs a_star pathfinding")
+
+
+def find_paths(grid, pathfinding="a_star", pool=None, sparse=False):
+    # step()'s pathfinding phase: both paths, (with obstacles, without obstacles), of
+    # everyone standing in grid.world, keyed by person. With sparse, "a_star" searches
+    # go through the grid's ActiveSet, which reuses the paths of everyone whose
+    # surroundings did not change. The route around other people comes from, per mode:
+    #   "a_star"        one search per person
+    #   "flow_field"    one CongestionField that prefers free cells over occupied ones
+    #   "shared"        one ExitTree around everyone's cells, same lengths as "a_star"
+    #   "cached"        the grid's PathCache, reusing routes across steps and people
+    #   "incremental"   the grid's IncrementalExitTree, "shared" repaired between steps
+    #   "hierarchical"  a PathHierarchy, searching around others only in the own cluster
+    _check_pathfinding(pathfinding, pool is not None)
+    if pool is not None:
+        return pool.find_paths(grid)
+
+    world = grid.world
+    paths = {}
+    field = path_hierarchy = active_set = None
+    if pathfinding == "a_star" and sparse:
+        active_set = grid.cached("active_set", ActiveSet)
+        active_set.refresh()
+    elif pathfinding == "flow_field":
+        field = CongestionField(grid)
+    elif pathfinding == "shared":
+        field = ExitTree(grid, person_obstacles=True)
+    elif pathfinding == "cached":
+        field = grid.cached("path_cache", PathCache)
+        field.refresh()
+    elif pathfinding == "incremental":
+        field = grid.cached("incremental_tree", IncrementalExitTree)
+        field.refresh()
+    elif pathfinding == "hierarchical":
+        path_hierarchy = hierarchy(grid)
+    for person in world.people.values():
+        if not person.isDead and not person.isFallen:
+            if active_set is not None:
+                paths[person] = active_set.paths(person)
+                continue
+            path_without_obstacles = path_from_distance_field(grid, person.location)
+            if field is not None:
+                path_with_obstacles = field.path(person.location)
+            elif path_hierarchy is not None:
+                path_with_obstacles = path_hierarchy.path(person.location, True)
+            else:
+                path_with_obstacles = person.a_star(grid, person.location, True)
+
+            paths[person] = (path_with_obstacles, path_without_obstacles)
+    return paths
+
+
+ENGINES = ("batched", "loop")
+
+
+def step(
+    grid, engine="batched", pathfinding="a_star", pool=None, profiler=None, sparse=False
+):
+    # Advances the simulation by one step (pathfinding, movement and status updates for
+    # everyone in grid.world) and returns that step's statistics. Nothing here draws or
+    # waits. engine is one of ENGINES: "batched" (move_people_batched) or "loop", the
+    # original person-by-person reference. pathfinding is one of PATHFINDING_MODES, see
+    # find_paths. With a PathfindingPool as pool the "a_star" searches run in its worker
+    # processes, a StepProfiler as profiler times every phase, and sparse is passed on
+    # to find_paths.
+    #
+    # statistics["settled"] is True once no further step can change anything: nobody is
+    # left standing or down, or this step started and ended with nobody restless (see
+    # AgentStore.restless) and nobody moved or left, so the next step would be the same
+    # again.
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown movement engine: {engine}")
+    world = grid.world
+    restless = world.agents.restless()
+    if profiler is None:
+        phase = _untimed
+    else:
+        phase = profiler.phase
+        profiler.begin_step()
+        context = search_context(grid)
+        expansions, heap_pushes = context.expansions, context.pushes
+        cache = (
+            grid.cached("path_cache", PathCache) if pathfinding == "cached" else None
+        )
+        hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+        # find_paths builds the IncrementalExitTree itself, so a new one counts in full
+        tree = grid.layout_cache.get("incremental_tree")
+        repaired = tree.expansions if tree else 0
+
+    # PATHFINDING LOGIC
+    with phase(grid, "pathfinding"):
+        paths = find_paths(grid, pathfinding, pool, sparse)
+    if profiler is not None:
+        current = grid.layout_cache.get("incremental_tree")
+        if current is not tree:
+            repaired = 0
+        repaired = current.expansions - repaired if current else 0
+
+    with phase(grid, "sorting"):
+        world.sort_people(
+            key=lambda person: nearest_exit_distance(grid, person.location)
+        )
+
+    # MOVEMENT LOGIC
+    starts = {person: person.location.index for person in paths} if profiler else None
+    with phase(grid, "movement"):
+        if engine == "loop":
+            people_to_remove, moved = move_people_sequentially(grid, paths)
+        else:
+            people_to_remove, moved = move_people_batched(grid, paths)
+
+    # STATUS LOGIC Statuses were updated turn by turn during movement; only the
+    # evacuated are left to remove
+    with phase(grid, "status"):
+        for person in people_to_remove:
+            world.remove(person)
+
+    statistics = {
+        "moved": moved,
+        "evacuated": len(people_to_remove),
+        "remaining": len(world.people),
+        "fallen": world.agents.count("is_fallen"),
+        "dead": world.agents.count("is_dead"),
+    }
+    standing = statistics["remaining"] - statistics["fallen"] - statistics["dead"]
+    statistics["settled"] = world.agents.restless() == 0 and (
+        standing == 0 or (restless == 0 and moved == 0 and not people_to_remove)
+    )
+    if profiler is not None:
+        profiler.count(
+            expansions=context.expansions - expansions + repaired,
+            heap_pushes=context.pushes - heap_pushes,
+            moves=moved,
+            conflicts=sum(
+                1
+                for person, start in starts.items()
+                if person.location.index == start
+                and any(path and len(path) > 1 for path in paths[person])
+            ),
+            people=statistics["remaining"],
+            cache_hits=cache.hits - hits if cache else 0,
+            cache_misses=cache.misses - misses if cache else 0,
+        )
+    return statistics
+
+
+def move_people_sequentially(grid, paths):
+    # Moves everyone one at a time in world order, each through the move_* methods, and
+    # updates each person's status at the end of their own turn. Returns the people who
+    # reached an exit and how many people changed cell.
+    people_to_remove = []
+    moved = 0
+    next_cell = None
+    for person in grid.world.people.values():
+        old_location = (person.location.x, person.location.y)
+
+        if not person.isDead and not person.isFallen:
+            path_with_obstacles, path_without_obstacles = paths[person]
 
-                # MOVEMENT LOGIC
-                people_to_remove = []
-                for person in Person.all_people:
-                    old_location = (person.location.x, person.location.y)
-
-                    if not person.isDead and not person.isFallen:
-                        path_with_obstacles, path_without_obstacles = paths[person]
-
-                        # if the person is rational or relaxed, prioritize path without obstacles
-                        if (person.isRational or person.isRelaxed) and not (
-                            person.isFallen or person.isDead
-                        ):
-
-                            # If both paths are available, prioritize the shortest path
-                            if path_without_obstacles and path_with_obstacles:
-                                if (
-                                    len(path_without_obstacles)
-                                    < len(path_with_obstacles)
-                                    and len(path_without_obstacles) > 1
-                                ):
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_without_obstacles[1][0],
-                                        path_without_obstacles[1][1],
-                                        grid,
-                                    )
-                                else: 
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_with_obstacles[1][0],
-                                        path_with_obstacles[1][1],
-                                        grid,
-                                    )
-                                    
-                                if (
-                                    next_cell is not None
-                                    and not next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    if next_cell.x > person.location.x:
-                                        person.move_right()
-                                    elif next_cell.x < person.location.x:
-                                        person.move_left()
-                                    elif next_cell.y > person.location.y:
-                                        person.move_down()
-                                    elif next_cell.y < person.location.y:
-                                        person.move_up()
-                            # only path with obstacles is available
-                            elif path_with_obstacles:
-                                if len(path_with_obstacles) > 1:
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_with_obstacles[1][0],
-                                        path_with_obstacles[1][1],
-                                        grid,
-                                    )
-                                if (
-                                    next_cell is not None
-                                    and not next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    if next_cell.x > person.location.x:
-                                        person.move_right()
-                                    elif next_cell.x < person.location.x:
-                                        person.move_left()
-                                    elif next_cell.y > person.location.y:
-                                        person.move_down()
-                                    elif next_cell.y < person.location.y:
-                                        person.move_up()
-                            # Did not move and resulted to without obstacles path
-                            else:
-                                if len(path_without_obstacles) > 1:
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_without_obstacles[1][0],
-                                        path_without_obstacles[1][1],
-                                        grid,
-                                    )
-                                if (
-                                    next_cell is not None
-                                    and not next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    if next_cell.x > person.location.x:
-                                        person.move_right()
-                                    elif next_cell.x < person.location.x:
-                                        person.move_left()
-                                    elif next_cell.y > person.location.y:
-                                        person.move_down()
-                                    elif next_cell.y < person.location.y:
-                                        person.move_up()
-                                
-                        # else the person is irration and will prioritize the path with obstacles
-                        elif not person.isRational and not (
-                            person.isFallen or person.isDead
-                        ):
-                            if path_with_obstacles:
-                                if len(path_with_obstacles) > 1:
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_with_obstacles[1][0],
-                                        path_with_obstacles[1][1],
-                                        grid,
-                                    )
-                                if (
-                                    next_cell is not None
-                                    and not next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    if next_cell.x > person.location.x:
-                                        person.move_right()
-                                    elif next_cell.x < person.location.x:
-                                        person.move_left()
-                                    elif next_cell.y > person.location.y:
-                                        person.move_down()
-                                    elif next_cell.y < person.location.y:
-                                        person.move_up()
-                                elif (
-                                    # if the next cell is occupied by a person
-                                    next_cell is not None
-                                    and next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    # if the person in the next cell is fallen or dead swap places
-                                    if (
-                                        next_cell.occupied.isFallen
-                                        or next_cell.occupied.isDead
-                                    ):
-                                        if next_cell.x > person.location.x:
-                                            person.move_right()
-                                            next_cell.occupied.move_left()
-                                        elif next_cell.x < person.location.x:
-                                            person.move_left()
-                                            next_cell.occupied.move_right()
-                                        elif next_cell.y > person.location.y:
-                                            person.move_down()
-                                            next_cell.occupied.move_up()
-                                        elif next_cell.y < person.location.y:
-                                            person.move_up()
-                                            next_cell.occupied.move_down()
-                                    # if the current person is strong
-                                    elif person.isStrong:
-                                        # if the next person is not strong, knock them down and swap places
-                                        if not next_cell.occupied.isStrong:
-                                            next_cell.occupied.fall()
-                                            next_cell.occupied.trampled()
-                                            if next_cell.x > person.location.x:
-                                                person.move_right()
-                                                next_cell.occupied.move_left()
-                                            elif next_cell.x < person.location.x:
-                                                person.move_left()
-                                                next_cell.occupied.move_right()
-                                            elif next_cell.y > person.location.y:
-                                                person.move_down()
-                                                next_cell.occupied.move_up()
-                                            elif next_cell.y < person.location.y:
-                                                person.move_up()
-                                                next_cell.occupied.move_down()
-                                    # else if the current person is weak and the next person is strong
-                                    elif (
-                                        not person.isStrong
-                                        and next_cell.occupied.isStrong
-                                    ):
-                                        # they knock themselves down
-                                        person.fall()
-
-                            elif path_without_obstacles:
-                                if len(path_without_obstacles) > 1:
-                                    next_cell = Cell.get_cell_from_coordinates(
-                                        path_without_obstacles[1][0],
-                                        path_without_obstacles[1][1],
-                                        grid,
-                                    )
-                                if (
-                                    next_cell is not None
-                                    and not next_cell.is_occupied()
-                                    and next_cell.cellType != "obstacle"
-                                ):
-                                    if next_cell.x > person.location.x:
-                                        person.move_right()
-                                    elif next_cell.x < person.location.x:
-                                        person.move_left()
-                                    elif next_cell.y > person.location.y:
-                                        person.move_down()
-                                    elif next_cell.y < person.location.y:
-                                        person.move_up()
-
-                        if person.location.cellType == "exit":
-                            people_to_remove.append(person)
-                            person.location.occupied = None
-                            
-
-                        if old_location == (person.location.x, person.location.y):
-                            person.blocked()
-
-                    person.update_status()
-                    next_cell.clear_if_exit()
-
-                for person in people_to_remove:
-                    Person.all_people.remove(person)
+            # if the person is rational or relaxed, prioritize path without obstacles
+            if (person.isRational or person.isRelaxed) and not (
+                person.isFallen or person.isDead
+            ):
+
+                # If both paths are available, prioritize the shortest path
+                if path_without_obstacles and path_with_obstacles:
+                    if (
+                        len(path_without_obstacles) < len(path_with_obstacles)
+                        and len(path_without_obstacles) > 1
+                    ):
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_without_obstacles[1][0],
+                            path_without_obstacles[1][1],
+                            grid,
+                        )
+                    else:
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_with_obstacles[1][0],
+                            path_with_obstacles[1][1],
+                            grid,
+                        )
+
+                    if (
+                        next_cell is not None
+                        and not next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        if next_cell.x > person.location.x:
+                            person.move_right()
+                        elif next_cell.x < person.location.x:
+                            person.move_left()
+                        elif next_cell.y > person.location.y:
+                            person.move_down()
+                        elif next_cell.y < person.location.y:
+                            person.move_up()
+                # only path with obstacles is available
+                elif path_with_obstacles:
+                    if len(path_with_obstacles) > 1:
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_with_obstacles[1][0],
+                            path_with_obstacles[1][1],
+                            grid,
+                        )
+                    if (
+                        next_cell is not None
+                        and not next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        if next_cell.x > person.location.x:
+                            person.move_right()
+                        elif next_cell.x < person.location.x:
+                            person.move_left()
+                        elif next_cell.y > person.location.y:
+                            person.move_down()
+                        elif next_cell.y < person.location.y:
+                            person.move_up()
+                # Did not move and resulted to without obstacles path
+                else:
+                    if len(path_without_obstacles) > 1:
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_without_obstacles[1][0],
+                            path_without_obstacles[1][1],
+                            grid,
+                        )
+                    if (
+                        next_cell is not None
+                        and not next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        if next_cell.x > person.location.x:
+                            person.move_right()
+                        elif next_cell.x < person.location.x:
+                            person.move_left()
+                        elif next_cell.y > person.location.y:
+                            person.move_down()
+                        elif next_cell.y < person.location.y:
+                            person.move_up()
+
+            # else the person is irration and will prioritize the path with obstacles
+            elif not person.isRational and not (person.isFallen or person.isDead):
+                if path_with_obstacles:
+                    if len(path_with_obstacles) > 1:
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_with_obstacles[1][0],
+                            path_with_obstacles[1][1],
+                            grid,
+                        )
+                    if (
+                        next_cell is not None
+                        and not next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        if next_cell.x > person.location.x:
+                            person.move_right()
+                        elif next_cell.x < person.location.x:
+                            person.move_left()
+                        elif next_cell.y > person.location.y:
+                            person.move_down()
+                        elif next_cell.y < person.location.y:
+                            person.move_up()
+                    elif (
+                        # if the next cell is occupied by a person
+                        next_cell is not None
+                        and next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        # if the person in the next cell is fallen or dead swap places
+                        if next_cell.occupied.isFallen or next_cell.occupied.isDead:
+                            if next_cell.x > person.location.x:
+                                person.move_right()
+                                next_cell.occupied.move_left()
+                            elif next_cell.x < person.location.x:
+                                person.move_left()
+                                next_cell.occupied.move_right()
+                            elif next_cell.y > person.location.y:
+                                person.move_down()
+                                next_cell.occupied.move_up()
+                            elif next_cell.y < person.location.y:
+                                person.move_up()
+                                next_cell.occupied.move_down()
+                        # if the current person is strong
+                        elif person.isStrong:
+                            # if the next person is not strong, knock them down and swap places
+                            if not next_cell.occupied.isStrong:
+                                next_cell.occupied.fall()
+                                next_cell.occupied.trampled()
+                                if next_cell.x > person.location.x:
+                                    person.move_right()
+                                    next_cell.occupied.move_left()
+                                elif next_cell.x < person.location.x:
+                                    person.move_left()
+                                    next_cell.occupied.move_right()
+                                elif next_cell.y > person.location.y:
+                                    person.move_down()
+                                    next_cell.occupied.move_up()
+                                elif next_cell.y < person.location.y:
+                                    person.move_up()
+                                    next_cell.occupied.move_down()
+                        # else if the current person is weak and the next person is strong
+                        elif not person.isStrong and next_cell.occupied.isStrong:
+                            # they knock themselves down
+                            person.fall()
+
+                elif path_without_obstacles:
+                    if len(path_without_obstacles) > 1:
+                        next_cell = Cell.get_cell_from_coordinates(
+                            path_without_obstacles[1][0],
+                            path_without_obstacles[1][1],
+                            grid,
+                        )
+                    if (
+                        next_cell is not None
+                        and not next_cell.is_occupied()
+                        and next_cell.cellType != "obstacle"
+                    ):
+                        if next_cell.x > person.location.x:
+                            person.move_right()
+                        elif next_cell.x < person.location.x:
+                            person.move_left()
+                        elif next_cell.y > person.location.y:
+                            person.move_down()
+                        elif next_cell.y < person.location.y:
+                            person.move_up()
+
+            if person.location.cellType == "exit":
+                people_to_remove.append(person)
+                person.location.occupied = None
+
+            if old_location == (person.location.x, person.location.y):
+                person.blocked()
+
+        if old_location != (person.location.x, person.location.y):
+            moved += 1
+
+        person.update_status()
+        if next_cell is not None:
+            next_cell.clear_if_exit()
+
+    return people_to_remove, moved
+
+
+def plan_moves(grid, people, paths):
+    # First pass of move_people_batched: the cell each person standing at the start of
+    # the step wants to step into, decided from their paths alone. Returns the target
+    # cell indexes (EMPTY for none) and whether each person pushes into an occupied
+    # target, which only irrational people following the path around others do.
+    targets = []
+    pushes = []
+    for person in people:
+        target, push = EMPTY, False
+        if person in paths:
+            path_with_obstacles, path_without_obstacles = paths[person]
+            # Rational or relaxed people take the route around others unless ignoring
+            # them is strictly shorter; irrational people only fall back to it when
+            # boxed in
+            if person.isRational or person.isRelaxed:
+                if path_without_obstacles and path_with_obstacles:
+                    if 1 < len(path_without_obstacles) < len(path_with_obstacles):
+                        path = path_without_obstacles
+                    else:
+                        path = path_with_obstacles
+                else:
+                    path = path_with_obstacles or path_without_obstacles
+            elif path_with_obstacles:
+                path, push = path_with_obstacles, True
+            else:
+                path = path_without_obstacles
+            if path and len(path) > 1:
+                x, y = path[1]
+                target = y * grid.cols + x
+        targets.append(target)
+        pushes.append(push)
+    return targets, pushes
+
+
+def move_people_batched(grid, paths):
+    # Same rules and results as move_people_sequentially, in two passes over the arrays:
+    # plan every target first, then settle who gets each cell in world order (the
+    # pre-movement sort), so someone earlier in that order claims a cell first and a
+    # cell someone left earlier in the step can be taken by anyone after them.
+    # Everyone's status is updated at the end of their own turn, as in the loop.
+    world = grid.world
+    people = list(world.people.values())
+    targets, pushes = plan_moves(grid, people, paths)
+
+    agents = world.agents
+    is_fallen, is_dead, is_strong = agents.is_fallen, agents.is_dead, agents.is_strong
+    fallen_counter, trampled_counter = agents.fallen_counter, agents.trampled_counter
+    blocked_counter = agents.blocked_counter
+    occupants, cell_types = grid.occupants, grid.cell_types
+
+    update_status = agents.update_status
+    people_to_remove = []
+    moved = 0
+    for person, target, push in zip(people, targets, pushes):
+        person_id = person.id
+        # Someone knocked down earlier in this step no longer gets to move
+        if is_dead[person_id] or is_fallen[person_id]:
+            update_status(person_id)
+            continue
+
+        start = person.location.index
+        if target != EMPTY and cell_types[target] != OBSTACLE:
+            occupant = occupants[target]
+            if occupant == EMPTY:
+                occupants[start] = EMPTY
+                occupants[target] = person_id
+                person.location = grid.cell(target)
+                moved += 1
+            elif push and not (is_fallen[occupant] or is_dead[occupant]):
+                # Pushing over someone on the ground is attempted as a swap, but both
+                # cells are taken so neither of them moves. Between two standing people,
+                # the strong knock the weak down and the weak fall against the strong.
+                if is_strong[person_id] and not is_strong[occupant]:
+                    is_fallen[occupant] = 1
+                    fallen_counter[occupant] = 0
+                    trampled_counter[occupant] += 1
+                elif not is_strong[person_id] and is_strong[occupant]:
+                    is_fallen[person_id] = 1
+                    fallen_counter[person_id] = 0
+
+        location = person.location.index
+        if cell_types[location] == EXIT:
+            people_to_remove.append(person)
+            occupants[location] = EMPTY
+        if location == start:
+            blocked_counter[person_id] += 1
+        update_status(person_id)
+
+    return people_to_remove, moved
+
+
+def run_simulation(grid, steps=10, after_step=None, profiler=None, until_settled=True):
+    # Steps through the simulation in a window, waiting for the user between steps. With
+    # until_settled it stops early, on a final frame, once a step reports the crowd
+    # settled.
+    import matplotlib.pyplot as plt
+    from IPython.display import clear_output
+
+    fig, ax = setup_grid_and_draw(grid)
+    auto_run = False
+    settled = False
+
+    print("\nRunning simulation...")
+    try:
+        for _ in range(steps + 1):
+            if _ != 0:
+                step_statistics = step(grid, profiler=profiler)
+                step_statistics["step"] = _
+                if after_step is not None:
+                    after_step(grid, step_statistics)
+                settled = until_settled and step_statistics["settled"]
             clear_output(wait=True)
-            draw_grid(grid, ax)
+            with (profiler.phase if profiler else _untimed)(grid, "drawing"):
+                draw_grid(grid, ax)
             if _ == 0:
                 plt.suptitle("Initial State")
-            elif _ == steps:
+            elif _ == steps or settled:
                 plt.suptitle("Final State")
             else:
                 plt.suptitle(f"Step {_} of {steps}")
             plt.draw()
             plt.pause(1)
 
+            if settled:
+                print(f"Nothing can change any more after step {_}; stopping early.")
+                break
             if auto_run:
                 # time.sleep(1)
                 print(f"Auto running step {_ + 1} of {steps}.")
@@ -574,6 +2430,636 @@ def run_simulation(grid, steps=10):
     plt.close(fig)
 
 
+def simulate(
+    grid,
+    steps=10,
+    seed=None,
+    engine="batched",
+    after_step=None,
+    pathfinding="a_star",
+    workers=None,
+    profiler=None,
+    sparse=False,
+    until_settled=True,
+):
+    # Headless counterpart of run_simulation: runs up to `steps` steps without drawing
+    # or prompting and returns one statistics dict per step. after_step, if given, is
+    # called with the grid and each step's statistics as soon as that step is done.
+    # engine and pathfinding are passed on to step, and so are profiler, a StepProfiler
+    # to time the run with, and sparse. workers > 1 spreads the pathfinding over that
+    # many processes through a PathfindingPool, without changing the results. With
+    # until_settled the run ends with the first step that reports the crowd settled,
+    # since every later step would be the same. seed, if given, only restarts the
+    # world's behaviour stream. Stepping draws no random numbers today, so it does not
+    # change the results, and master_seed still names the seed the world was built with.
+    # Checked up front, so a bad mode fails before any worker process is started
+    pooled = bool(workers and workers > 1)
+    _check_pathfinding(pathfinding, pooled)
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown movement engine: {engine}")
+    if seed is not None:
+        grid.world.reseed("behaviour", seed)
+    pool = PathfindingPool(grid, workers) if pooled else None
+    statistics = []
+    try:
+        for step_number in range(1, steps + 1):
+            step_statistics = step(grid, engine, pathfinding, pool, profiler, sparse)
+            step_statistics["step"] = step_number
+            statistics.append(step_statistics)
+            if after_step is not None:
+                after_step(grid, step_statistics)
+            if until_settled and step_statistics["settled"]:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+    return statistics
+
+
+def export_simulation(
+    grid, steps, path, fps=2, dpi=100, show_ids=True, after_step=None, profiler=None
+):
+    # Runs the simulation like simulate() and writes every frame to a video or GIF at
+    # path as it is drawn. Frames are rendered offscreen on an Agg canvas (no window, no
+    # pause) and piped straight to ffmpeg, or ImageMagick for GIFs, so they are never
+    # all held in memory. Without either tool a GIF can still be written with Pillow,
+    # which does buffer the frames.
+    from matplotlib import animation
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    if animation.writers.is_available("ffmpeg"):
+        writer = animation.FFMpegWriter(fps=fps)
+    elif path.lower().endswith(".gif") and animation.writers.is_available(
+        "imagemagick"
+    ):
+        writer = animation.ImageMagickWriter(fps=fps)
+    elif path.lower().endswith(".gif"):
+        print(
+            "ffmpeg and ImageMagick not found; "
+            "buffering GIF frames with Pillow instead."
+        )
+        writer = animation.PillowWriter(fps=fps)
+    else:
+        raise RuntimeError(f"Writing {path} needs ffmpeg on the PATH")
+
+    fig = Figure(figsize=(10, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    def write_frame(title):
+        with (profiler.phase if profiler else _untimed)(grid, "drawing"):
+            draw_grid(grid, ax, show_ids)
+            fig.suptitle(title)
+            writer.grab_frame()
+
+    def write_step(grid, step_statistics):
+        step_number = step_statistics["step"]
+        if step_number == steps or step_statistics["settled"]:
+            write_frame("Final State")
+        else:
+            write_frame(f"Step {step_number} of {steps}")
+        if after_step is not None:
+            after_step(grid, step_statistics)
+
+    with writer.saving(fig, path, dpi):
+        write_frame("Initial State")
+        statistics = simulate(grid, steps, after_step=write_step, profiler=profiler)
+    return statistics
+
+
+class TrajectoryRecorder:
+    # Writes the state of everyone on a grid after every step to an append-only binary
+    # file that TrajectoryReader can memory-map. Steps are grouped into zlib-compressed
+    # chunks of chunk_steps. A chunk opens with a keyframe of every person (id, x, y,
+    # flags) and then stores, per step, only the people whose position or flags changed:
+    # the gaps between their sorted ids, their x/y movement and their new flags. The
+    # starting state is recorded on creation; pass record as simulate()'s after_step to
+    # record every step after that. File layout (little-endian): the HEADER, then for
+    # each chunk a CHUNK header followed by its compressed payload.
+    MAGIC = b"STMPTRJ1"
+    HEADER = struct.Struct("<8sIII")  # magic, rows, cols, chunk_steps
+    # b"CHNK", first step, step count, compressed, raw size
+    CHUNK = struct.Struct("<4sIIII")
+    COUNT = struct.Struct("<I")
+    FALLEN, DEAD, RELAXED, GONE = 1, 2, 4, 8  # Bits of a person's flags byte
+
+    def __init__(self, path, grid, chunk_steps=64):
+        self.file = open(path, "wb")
+        self.file.write(self.HEADER.pack(self.MAGIC, grid.rows, grid.cols, chunk_steps))
+        self.chunk_steps = chunk_steps
+        self.chunk = []
+        self.first_step = None
+        self.step_number = -1
+        self.previous = None
+        self.record(grid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def snapshot(self, grid):
+        import numpy as np
+
+        agents = grid.world.agents
+        ids = np.flatnonzero(agents.view("active")).astype(np.uint32)
+        flags = (
+            agents.view("is_fallen")[ids] * self.FALLEN
+            + agents.view("is_dead")[ids] * self.DEAD
+            + agents.view("is_relaxed")[ids] * self.RELAXED
+        ).astype(np.uint8)
+        return ids, agents.view("x")[ids].copy(), agents.view("y")[ids].copy(), flags
+
+    def record(self, grid, step_statistics=None):
+        import numpy as np
+
+        self.step_number += 1
+        ids, x, y, flags = self.snapshot(grid)
+        previous = self.previous
+        # A keyframe is also needed if someone appeared who has no earlier position to
+        # move from
+        keyframe = (
+            previous is None
+            or len(self.chunk) == self.chunk_steps
+            or not np.isin(ids, previous[0]).all()
+        )
+        if not keyframe:
+            previous_ids, previous_x, previous_y, previous_flags = previous
+            stayed = np.isin(previous_ids, ids)
+            # ids only ever shrink between keyframes, so the people still here line up
+            dx = x - previous_x[stayed]
+            dy = y - previous_y[stayed]
+            # Movement is stored in one signed byte, so if record was not called every
+            # step a bigger jump needs a keyframe as well
+            keyframe = len(ids) > 0 and max(abs(dx).max(), abs(dy).max()) > 127
+        if keyframe:
+            self.flush()
+            self.first_step = self.step_number
+            self.chunk.append(
+                self.COUNT.pack(len(ids))
+                + ids.tobytes()
+                + x.astype(np.int32).tobytes()
+                + y.astype(np.int32).tobytes()
+                + flags.tobytes()
+            )
+        else:
+            changed = (dx != 0) | (dy != 0) | (flags != previous_flags[stayed])
+            changed_ids = np.concatenate([ids[changed], previous_ids[~stayed]])
+            order = np.argsort(changed_ids, kind="stable")
+            changed_ids = changed_ids[order]
+            gone = np.zeros(np.count_nonzero(~stayed), dtype=np.int32)
+            changed_dx = np.concatenate([dx[changed], gone])[order].astype(np.int8)
+            changed_dy = np.concatenate([dy[changed], gone])[order].astype(np.int8)
+            changed_flags = np.concatenate(
+                [flags[changed], previous_flags[~stayed] | self.GONE]
+            )[order].astype(np.uint8)
+            gaps = np.diff(changed_ids, prepend=np.uint32(0)).astype(np.uint32)
+            self.chunk.append(
+                self.COUNT.pack(len(changed_ids))
+                + gaps.tobytes()
+                + changed_dx.tobytes()
+                + changed_dy.tobytes()
+                + changed_flags.tobytes()
+            )
+        self.previous = (ids, x, y, flags)
+
+    def flush(self):
+        if not self.chunk:
+            return
+        raw = b"".join(self.chunk)
+        compressed = zlib.compress(raw, 6)
+        self.file.write(
+            self.CHUNK.pack(
+                b"CHNK", self.first_step, len(self.chunk), len(compressed), len(raw)
+            )
+        )
+        self.file.write(compressed)
+        self.file.flush()
+        self.chunk = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TrajectoryReader:
+    # Reads a TrajectoryRecorder file through mmap. Opening it only walks the chunk
+    # headers, so state(step) decodes just the one chunk holding that step, from its
+    # keyframe on.
+    def __init__(self, path):
+        import mmap
+
+        with open(path, "rb") as trajectory_file:
+            self.data = mmap.mmap(trajectory_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = TrajectoryRecorder.HEADER
+        magic, self.rows, self.cols, self.chunk_steps = header.unpack_from(self.data, 0)
+        if magic != TrajectoryRecorder.MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+
+        # (first step, step count, payload offset, compressed size) per chunk. A chunk
+        # cut off by a crash while it was being written is ignored.
+        self.chunks = []
+        chunk = TrajectoryRecorder.CHUNK
+        offset = header.size
+        while offset + chunk.size <= len(self.data):
+            tag, first_step, count, compressed, _ = chunk.unpack_from(self.data, offset)
+            offset += chunk.size
+            if tag != b"CHNK" or offset + compressed > len(self.data):
+                break
+            self.chunks.append((first_step, count, offset, compressed))
+            offset += compressed
+        self.chunk_starts = [first_step for first_step, _, _, _ in self.chunks]
+
+    @property
+    def steps(self):
+        # Number of recorded steps after the initial state
+        if not self.chunks:
+            return -1
+        first_step, count, _, _ = self.chunks[-1]
+        return first_step + count - 1
+
+    def state(self, step_number):
+        # Everyone on the grid after step_number, as NumPy arrays sorted by id: "id",
+        # "x", "y", "is_fallen", "is_dead" and "is_relaxed"
+        chunk_number = bisect.bisect_right(self.chunk_starts, step_number) - 1
+        if chunk_number < 0 or step_number > self.steps:
+            raise IndexError(f"step {step_number} was not recorded")
+        for decoded_step, state in self._decode_chunk(chunk_number):
+            if decoded_step == step_number:
+                return state
+
+    def __iter__(self):
+        # (step, state) for every recorded step, in order
+        for chunk_number in range(len(self.chunks)):
+            yield from self._decode_chunk(chunk_number)
+
+    def _decode_chunk(self, chunk_number):
+        import numpy as np
+
+        first_step, count, offset, compressed = self.chunks[chunk_number]
+        raw = zlib.decompress(self.data[offset : offset + compressed])
+        size = TrajectoryRecorder.COUNT.size
+        position = 0
+        for step_number in range(first_step, first_step + count):
+            (n,) = TrajectoryRecorder.COUNT.unpack_from(raw, position)
+            position += size
+            if step_number == first_step:
+                ids = np.frombuffer(raw, np.uint32, n, position).copy()
+                x = np.frombuffer(raw, np.int32, n, position + 4 * n).copy()
+                y = np.frombuffer(raw, np.int32, n, position + 8 * n).copy()
+                flags = np.frombuffer(raw, np.uint8, n, position + 12 * n).copy()
+                position += 13 * n
+            else:
+                changed_ids = np.cumsum(
+                    np.frombuffer(raw, np.uint32, n, position), dtype=np.uint32
+                )
+                dx = np.frombuffer(raw, np.int8, n, position + 4 * n)
+                dy = np.frombuffer(raw, np.int8, n, position + 5 * n)
+                changed_flags = np.frombuffer(raw, np.uint8, n, position + 6 * n)
+                position += 7 * n
+                where = np.searchsorted(ids, changed_ids)
+                x[where] += dx
+                y[where] += dy
+                flags[where] = changed_flags
+                keep = (flags & TrajectoryRecorder.GONE) == 0
+                ids, x, y, flags = ids[keep], x[keep], y[keep], flags[keep]
+            yield step_number, {
+                "id": ids,
+                "x": x,
+                "y": y,
+                "is_fallen": (flags & TrajectoryRecorder.FALLEN) != 0,
+                "is_dead": (flags & TrajectoryRecorder.DEAD) != 0,
+                "is_relaxed": (flags & TrajectoryRecorder.RELAXED) != 0,
+            }
+
+
+def print_statistics(statistics):
+    columns = ["step", "moved", "evacuated", "remaining", "fallen", "dead"]
+    print(",".join(columns))
+    for step_statistics in statistics:
+        print(",".join(str(step_statistics[column]) for column in columns))
+
+
+def add_random_obstacles(grid, count):
+    # Turns `count` cells drawn from the world's layout stream into obstacles (a cell
+    # can be drawn twice)
+    rng = grid.world.rng("layout")
+    for _ in range(count):
+        i, j = rng.randint(0, grid.rows - 1), rng.randint(0, grid.cols - 1)
+        grid[i][j].cellType = "obstacle"
+
+
+def create_preset_grid(choice, seed=None):
+    # Presets 1, 3, 4 and 5 are floor plans in LAYOUT_DIR; preset 2 has random
+    # obstacles. The grid's world is seeded with `seed`, which fixes preset 2's
+    # obstacles and every later random draw.
+    if choice == "2":
+        grid = create_grid(8, 8)
+    elif choice in ("1", "3", "4", "5"):
+        grid = load_layout(os.path.join(LAYOUT_DIR, f"preset{choice}.txt"))
+    else:
+        raise ValueError(f"Unknown preset grid: {choice}")
+    grid.world.seed(seed)
+    if choice == "1":
+        grid[0][0].occupied = Person(True, True, False, grid[0][0])
+        grid[2][2].occupied = Person(False, True, True, grid[2][2])
+        grid[4][4].occupied = Person(True, False, True, grid[4][4])
+    elif choice == "2":
+        add_random_obstacles(grid, 10)
+        grid[0][0].cellType = "exit"
+    return grid
+
+
+def create_debug_scenario(name):
+    # The fixed, fully populated scenarios behind "python stampede.py debug1/debug2".
+    # Returns the grid and the number of steps to run it for.
+    seed = 1
+    if name == "debug1":
+        grid = create_grid(5, 5)
+        grid.world.seed(seed)
+        grid[0][4].cellType = "exit"
+        grid[4][2].cellType = "exit"
+        grid[1][1].cellType = "obstacle"
+        grid[3][3].cellType = "obstacle"
+        grid[0][0].occupied = Person(True, True, False, grid[0][0])
+        grid[2][2].occupied = Person(False, True, True, grid[2][2])
+        grid[4][4].occupied = Person(True, False, True, grid[4][4])
+        walkable_count = grid.count("walkable")
+        density, rational, strong, relaxed, max_steps = 20, 20, 20, 20, 20
+    elif name == "debug2":
+        grid = create_grid(8, 8)
+        grid.world.seed(seed)
+        walkable_count = grid.count("walkable")
+        add_random_obstacles(grid, 10)
+        grid[0][0].cellType = "exit"
+        density, rational, strong, relaxed, max_steps = 50, 50, 50, 50, 30
+    else:
+        raise ValueError(f"Unknown debug scenario: {name}")
+
+    place_people(grid, int((density / 100) * walkable_count), rational, strong, relaxed)
+    return grid, max_steps
+
+
+def place_people(grid, total_people, rational, strong, relaxed, weights=None):
+    # Places up to total_people on distinct free walkable cells, drawn without
+    # replacement from the list of those cells, and returns how many were placed (fewer
+    # only if the grid runs out of free cells). weights optionally gives every cell a
+    # non-negative weight (a flat or rows x cols map, e.g. from zone_weights): cells are
+    # then drawn in proportion to it and cells of weight 0 are left empty. Everything is
+    # drawn from the world's placement stream, so a seed always gives the same crowd.
+    # Traits are drawn for the whole crowd in one call to that stream's NumPy generator,
+    # which keeps large populations cheap.
+    import numpy as np
+
+    rng = grid.world.rng("placement")
+    free = (np.frombuffer(grid.cell_types, dtype=np.int8) == WALKABLE) & (
+        np.frombuffer(grid.occupants, dtype=np.int32) == EMPTY
+    )
+    if weights is None:
+        candidates = np.flatnonzero(free).tolist()
+        chosen = rng.sample(candidates, min(total_people, len(candidates)))
+    else:
+        weights = np.asarray(weights, dtype=float).ravel()
+        if len(weights) != grid.rows * grid.cols or (weights < 0).any():
+            raise ValueError("weights needs one non-negative weight per cell")
+        candidates = np.flatnonzero(free & (weights > 0))
+        # Weighted sampling without replacement (Efraimidis-Spirakis): every candidate
+        # gets the key log(u) / weight and the largest keys win
+        keys = [
+            (math.log(1.0 - rng.random()) / weight, index)
+            for index, weight in zip(candidates.tolist(), weights[candidates].tolist())
+        ]
+        chosen = [index for _, index in heapq.nlargest(total_people, keys)]
+
+    # One row of (rational, strong, relaxed) flags per person
+    chances = np.array([rational, strong, relaxed]) / 100
+    traits = (
+        grid.world.generator("placement").random((len(chosen), 3)) < chances
+    ).tolist()
+    for index, (is_rational, is_strong, is_relaxed) in zip(chosen, traits):
+        cell = grid.cell(index)
+        cell.occupied = Person(is_strong, is_rational, is_relaxed, cell)
+    return len(chosen)
+
+
+def zone_weights(grid, zones, default=0.0):
+    # A weight map for place_people from rectangular zones given as (top, left, bottom,
+    # right, weight), bottom and right inclusive. Later zones override earlier ones
+    # where they overlap and cells outside every zone get default.
+    import numpy as np
+
+    weights = np.full((grid.rows, grid.cols), float(default))
+    for top, left, bottom, right, weight in zones:
+        weights[top : bottom + 1, left : right + 1] = weight
+    return weights
+
+
+SWEEP_PARAMETERS = ["layout", "density", "rational", "strong", "relaxed", "steps"]
+
+
+def run_scenario(layout, seed, density, rational, strong, relaxed, steps):
+    # One headless run of a preset layout in its own World
+    grid = create_preset_grid(layout, seed)
+    walkable_count = grid.count("walkable")
+    place_people(grid, int((density / 100) * walkable_count), rational, strong, relaxed)
+    population = len(grid.world.people)
+    statistics = simulate(grid, steps)
+
+    # Evacuation time is the first step after which only dead people are left (None if
+    # the crowd never got out within the step limit)
+    evacuation_time = None
+    for step_statistics in statistics:
+        if step_statistics["remaining"] == step_statistics["dead"]:
+            evacuation_time = step_statistics["step"]
+            break
+    return {
+        "layout": layout,
+        "seed": seed,
+        "density": density,
+        "rational": rational,
+        "strong": strong,
+        "relaxed": relaxed,
+        "steps": steps,
+        "population": population,
+        "deaths": statistics[-1]["dead"] if statistics else 0,
+        "evacuated": sum(
+            step_statistics["evacuated"] for step_statistics in statistics
+        ),
+        "evacuation_time": evacuation_time,
+        "peak_fallen": max((s["fallen"] for s in statistics), default=0),
+    }
+
+
+def _scenario_key(scenario):
+    return tuple(scenario[name] for name in SWEEP_PARAMETERS + ["seed"])
+
+
+def load_sweep_results(results_path):
+    results = []
+    if os.path.exists(results_path):
+        with open(results_path) as results_file:
+            for line in results_file:
+                line = line.strip()
+                # A run that was killed mid-write can leave a partial last line behind
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    return results
+
+
+def run_sweep(scenarios, results_path, workers=None):
+    # Runs every scenario (a dict of run_scenario's arguments) across a process pool and
+    # appends each result to results_path as a JSON line as soon as it finishes.
+    # Scenarios that already have a result in the file are skipped, so an interrupted
+    # sweep resumes where it stopped.
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    done = {_scenario_key(result) for result in load_sweep_results(results_path)}
+    pending = [
+        scenario for scenario in scenarios if _scenario_key(scenario) not in done
+    ]
+    print(
+        f"{len(scenarios) - len(pending)} of {len(scenarios)} scenarios already done."
+    )
+
+    # Drop what a killed run left of a last line, so the next result starts a line of
+    # its own instead of being glued onto the fragment
+    if os.path.exists(results_path):
+        with open(results_path, "rb+") as results_file:
+            data = results_file.read()
+            results_file.truncate(data.rfind(b"\n") + 1)
+
+    with open(results_path, "a") as results_file:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(run_scenario, **scenario) for scenario in pending
+            ]
+            for finished, future in enumerate(as_completed(futures), 1):
+                results_file.write(json.dumps(future.result()) + "\n")
+                results_file.flush()
+                print(f"Finished scenario {finished} of {len(pending)}.")
+
+    return aggregate_sweep(load_sweep_results(results_path))
+
+
+def aggregate_sweep(results):
+    # Averages the runs of each configuration (everything but the seed)
+    groups = {}
+    for result in results:
+        groups.setdefault(tuple(result[name] for name in SWEEP_PARAMETERS), []).append(
+            result
+        )
+
+    summary = []
+    for key, runs in sorted(groups.items()):
+        evacuation_times = [
+            run["evacuation_time"] for run in runs if run["evacuation_time"] is not None
+        ]
+        summary.append(
+            dict(
+                zip(SWEEP_PARAMETERS, key),
+                runs=len(runs),
+                mean_deaths=sum(run["deaths"] for run in runs) / len(runs),
+                max_deaths=max(run["deaths"] for run in runs),
+                evacuated_runs=len(evacuation_times),
+                mean_evacuation_time=(
+                    sum(evacuation_times) / len(evacuation_times)
+                    if evacuation_times
+                    else None
+                ),
+                mean_peak_fallen=sum(run["peak_fallen"] for run in runs) / len(runs),
+            )
+        )
+    return summary
+
+
+def parse_seeds(text):
+    # "7" -> [7], "0-99" -> [0, ..., 99], "1,5,9" -> [1, 5, 9]
+    seeds = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            seeds.extend(range(int(first), int(last) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+def sweep_main(args):
+    # Example: python stampede.py sweep --layouts 3 4 --seeds 0-99 --density 20 50 80
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="stampede.py sweep",
+        description="Run preset layouts headlessly over many seeds and trait mixes.",
+    )
+    parser.add_argument(
+        "--layouts", nargs="+", default=["3"], help="preset grid numbers"
+    )
+    parser.add_argument("--seeds", default="0-9", help="e.g. 0-99 or 1,5,9")
+    parser.add_argument("--density", nargs="+", type=int, default=[50])
+    parser.add_argument("--rational", nargs="+", type=int, default=[50])
+    parser.add_argument("--strong", nargs="+", type=int, default=[50])
+    parser.add_argument("--relaxed", nargs="+", type=int, default=[50])
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="sweep_results.jsonl")
+    options = parser.parse_args(args)
+
+    scenarios = [
+        {
+            "layout": layout,
+            "seed": seed,
+            "density": density,
+            "rational": rational,
+            "strong": strong,
+            "relaxed": relaxed,
+            "steps": options.steps,
+        }
+        for layout, density, rational, strong, relaxed, seed in itertools.product(
+            options.layouts,
+            options.density,
+            options.rational,
+            options.strong,
+            options.relaxed,
+            parse_seeds(options.seeds),
+        )
+    ]
+    summary = run_sweep(scenarios, options.output, options.workers)
+
+    columns = SWEEP_PARAMETERS + [
+        "runs",
+        "mean_deaths",
+        "max_deaths",
+        "evacuated_runs",
+        "mean_evacuation_time",
+        "mean_peak_fallen",
+    ]
+    print(",".join(columns))
+    for row in summary:
+        print(
+            ",".join(
+                "" if row[column] is None else str(row[column]) for column in columns
+            )
+        )
+
+
+def replay_main(args):
+    # python stampede.py replay PATH STEP prints everyone's recorded state after STEP as
+    # CSV
+    if len(args) != 2:
+        print("Usage: python stampede.py replay PATH STEP")
+        return
+    reader = TrajectoryReader(args[0])
+    state = reader.state(int(args[1]))
+    print("id,x,y,fallen,dead,relaxed")
+    for row in zip(*(state[name].tolist() for name in state)):
+        print(",".join(str(int(value)) for value in row))
+
+
 def input_safe(prompt, default_func):
     user_input = input(prompt)
     if user_input == "":
@@ -585,67 +3071,77 @@ def input_safe(prompt, default_func):
 
 def main():
     args = sys.argv[1:]
+    # --headless runs the chosen scenario without matplotlib or step prompts and prints
+    # per-step statistics as CSV instead. Example: python stampede.py debug1 --headless
+    headless = "--headless" in args
+    args = [arg for arg in args if arg != "--headless"]
+    # --export PATH renders the run offscreen straight into a video or GIF file instead
+    # of a window. Example: python stampede.py debug2 --export debug2.mp4
+    export_path = None
+    if "--export" in args:
+        position = args.index("--export")
+        export_path = args[position + 1]
+        del args[position : position + 2]
+    # --record PATH also writes every step to a trajectory file that TrajectoryReader
+    # can replay. Example: python stampede.py debug2 --headless --record debug2.trj
+    record_path = None
+    if "--record" in args:
+        position = args.index("--record")
+        record_path = args[position + 1]
+        del args[position : position + 2]
+    # --timings PATH saves a StepProfiler table of per-phase times and counters for
+    # every step (JSON if PATH ends in .json, CSV otherwise). --profile runs everything
+    # under cProfile, or pyinstrument with --profile pyinstrument, and prints the
+    # hottest calls to stderr.
+    timings_path = None
+    if "--timings" in args:
+        position = args.index("--timings")
+        timings_path = args[position + 1]
+        del args[position : position + 2]
+    profile_tool = None
+    if "--profile" in args:
+        position = args.index("--profile")
+        profile_tool = "cprofile"
+        if args[position + 1 : position + 2] == ["pyinstrument"]:
+            profile_tool = "pyinstrument"
+            del args[position + 1]
+        del args[position]
+    if args and args[0] == "sweep":
+        sweep_main(args[1:])
+        return
+    if args and args[0] == "replay":
+        replay_main(args[1:])
+        return
     # For debugging purposes, we can pass in arguments to the script to skip the input prompts.
     # Example: python stampede.py debug
     # Can remove in final version.
     if args and args[0] == "debug1":
         print("Running in debug grid.")
         print("5x5 grid with two obstacles")
-        grid = create_grid(5, 5)
-        grid[0][4].cellType = "exit"
-        grid[4][2].cellType = "exit"
-        grid[1][1].cellType = "obstacle"
-        grid[3][3].cellType = "obstacle"
-        grid[0][0].occupied = Person(True, True, False, grid[0][0])
-        grid[2][2].occupied = Person(False, True, True, grid[2][2])
-        grid[4][4].occupied = Person(True, False, True, grid[4][4])
-        walkable_count = sum(
-            1 for row in grid for cell in row if cell.cellType == "walkable"
-        )
         print("Population density: 20%")
-        density = 20
         print("Rational: 20%")
-        rational = 20
         print("Strong: 20%")
-        strong = 20
         print("Relaxed: 20%")
-        relaxed = 20
         print("Seed: 1")
-        seed = 1
-        random.seed(int(seed))
         print("Max steps: 20")
-        max_steps = 20
+        grid, max_steps = create_debug_scenario("debug1")
 
     elif args and args[0] == "debug2":
         print("Running in debug grid.")
         print("8x8 grid with obstacles")
-        print("Population density: 20%")
-        density = 50
-        print("Rational: 20%")
-        rational = 50
-        print("Strong: 20%")
-        strong = 50
-        print("Relaxed: 20%")
-        relaxed = 50
+        print("Population density: 50%")
+        print("Rational: 50%")
+        print("Strong: 50%")
+        print("Relaxed: 50%")
         print("Seed: 1")
-        seed = 1
-        random.seed(int(seed))
-        print("Max steps: 20")
-        max_steps = 30
-        grid = create_grid(8, 8)
-        walkable_count = sum(
-            1 for row in grid for cell in row if cell.cellType == "walkable"
-        )
-        # Add random obstacles
-        for _ in range(10):
-            i, j = random.randint(0, 7), random.randint(0, 7)
-            grid[i][j].cellType = "obstacle"
-        grid[0][0].cellType = "exit"
+        print("Max steps: 30")
+        grid, max_steps = create_debug_scenario("debug2")
 
     else:
         print("Welcome to the Crowd Stampede Simulation Setup!")
         grid_selection = input(
-            "Type '1' to use a pre-made grid, or '2' to create your own grid: "
+            "Type '1' to use a pre-made grid, '2' to create your own grid, "
+            "or '3' to load a floor plan file: "
         )
         if grid_selection.lower() == "1":
             # Add more grids for more predefined experiments?
@@ -654,170 +3150,16 @@ def main():
                 "2": "8x8 grid with random obstacles",
                 "3": "50x20 hallway with large obstacles and few exits",
                 "4": "10x25 hallway with many obstacles and 1 exit",
-                "5": "10x25 hallway with safer design"
+                "5": "10x25 hallway with safer design",
             }
             print("Available grids:")
             for name, description in grids.items():
                 print(f"{name}: {description}")
             grid_choice = input("Choose a grid: ")
-            if grid_choice == "1":
-                grid = create_grid(5, 5)
-                grid[0][4].cellType = "exit"
-                grid[1][1].cellType = "obstacle"
-                grid[3][3].cellType = "obstacle"
-                grid[0][0].occupied = Person(True, True, False, grid[0][0])
-                grid[2][2].occupied = Person(False, True, True, grid[2][2])
-                grid[4][4].occupied = Person(True, False, True, grid[4][4])
-            elif grid_choice == "2":
-                grid = create_grid(8, 8)
-                # Add random obstacles
-                for _ in range(10):
-                    i, j = random.randint(0, 7), random.randint(0, 7)
-                    grid[i][j].cellType = "obstacle"
-                grid[0][0].cellType = "exit"
-            elif grid_choice == "3":
-                grid = create_grid(20, 50)
-                grid[6][0].cellType = "exit"
-                grid[7][0].cellType = "exit"
-
-                grid[12][0].cellType = "exit"
-                grid[13][0].cellType = "exit"
-
-                grid[6][49].cellType = "exit"
-                grid[7][49].cellType = "exit"
-
-                grid[12][49].cellType = "exit"
-                grid[13][49].cellType = "exit"
-
-                grid[0][15].cellType = "exit"
-
-                grid[0][35].cellType = "exit"
-
-                grid[19][15].cellType = "exit"
-
-                grid[19][35].cellType = "exit"
-
-                grid[9][9].cellType = "obstacle"
-                grid[9][10].cellType = "obstacle"
-                grid[10][9].cellType = "obstacle"
-                grid[10][10].cellType = "obstacle"
-
-                grid[9][19].cellType = "obstacle"
-                grid[9][20].cellType = "obstacle"
-                grid[10][19].cellType = "obstacle"
-                grid[10][20].cellType = "obstacle"
-
-                grid[9][29].cellType = "obstacle"
-                grid[9][30].cellType = "obstacle"
-                grid[10][29].cellType = "obstacle"
-                grid[10][30].cellType = "obstacle"
-
-                grid[9][39].cellType = "obstacle"
-                grid[9][40].cellType = "obstacle"
-                grid[10][39].cellType = "obstacle"
-                grid[10][40].cellType = "obstacle"
-            elif grid_choice == '4':
-                grid = create_grid(10, 25)
-                grid[4][0].cellType = "exit"
-                grid[5][0].cellType = "exit"
-
-                grid [4][5].cellType = "obstacle"
-                grid [5][5].cellType = "obstacle"
-                grid [4][6].cellType = "obstacle"
-                grid [5][6].cellType = "obstacle"
-
-                grid [4][10].cellType = "obstacle"
-                grid [5][10].cellType = "obstacle"
-                grid [4][11].cellType = "obstacle"
-                grid [5][11].cellType = "obstacle"
-
-                grid [4][15].cellType = "obstacle"
-                grid [5][15].cellType = "obstacle"
-                grid [4][16].cellType = "obstacle"
-                grid [5][16].cellType = "obstacle"
-
-                grid [4][20].cellType = "obstacle"
-                grid [5][20].cellType = "obstacle"
-                grid [4][21].cellType = "obstacle"
-                grid [5][21].cellType = "obstacle"
-
-                grid [0][1].cellType = "obstacle"
-                grid [0][2].cellType = "obstacle"
-                grid [0][3].cellType = "obstacle"
-                grid [0][4].cellType = "obstacle"
-                grid [0][5].cellType = "obstacle"
-
-                grid [9][1].cellType = "obstacle"
-                grid [9][2].cellType = "obstacle"
-                grid [9][3].cellType = "obstacle"
-                grid [9][4].cellType = "obstacle"
-                grid [9][5].cellType = "obstacle"
-
-                grid [0][24].cellType = "obstacle"
-                grid [0][23].cellType = "obstacle"
-                grid [0][22].cellType = "obstacle"
-                grid [0][21].cellType = "obstacle"
-                grid [0][20].cellType = "obstacle"
-
-                grid [9][24].cellType = "obstacle"
-                grid [9][23].cellType = "obstacle"
-                grid [9][22].cellType = "obstacle"
-                grid [9][21].cellType = "obstacle"
-                grid [9][20].cellType = "obstacle"
-
-            elif grid_choice == '5':
-                grid = create_grid(10, 25)
-                grid[4][0].cellType = "exit"
-                grid[5][0].cellType = "exit"
-
-                grid[4][24].cellType = "exit"
-                grid[5][24].cellType = "exit"
-
-                grid[3][24].cellType = "exit"
-                grid[6][24].cellType = "exit"
-
-                grid[3][0].cellType = "exit"
-                grid[6][0].cellType = "exit"
-
-                grid[0][13].cellType = "exit"
-                grid[0][12].cellType = "exit"
-
-                grid[9][13].cellType = "exit"
-                grid[9][12].cellType = "exit"
-
-                grid [4][5].cellType = "obstacle"
-                grid [5][5].cellType = "obstacle"
-                grid [4][6].cellType = "obstacle"
-                grid [5][6].cellType = "obstacle"
-
-                grid [4][20].cellType = "obstacle"
-                grid [5][20].cellType = "obstacle"
-                grid [4][21].cellType = "obstacle"
-                grid [5][21].cellType = "obstacle"
-
-                grid [0][1].cellType = "obstacle"
-                grid [0][2].cellType = "obstacle"
-                grid [0][3].cellType = "obstacle"
-                grid [0][4].cellType = "obstacle"
-                grid [0][5].cellType = "obstacle"
-
-                grid [9][1].cellType = "obstacle"
-                grid [9][2].cellType = "obstacle"
-                grid [9][3].cellType = "obstacle"
-                grid [9][4].cellType = "obstacle"
-                grid [9][5].cellType = "obstacle"
-
-                grid [0][24].cellType = "obstacle"
-                grid [0][23].cellType = "obstacle"
-                grid [0][22].cellType = "obstacle"
-                grid [0][21].cellType = "obstacle"
-                grid [0][20].cellType = "obstacle"
-
-                grid [9][24].cellType = "obstacle"
-                grid [9][23].cellType = "obstacle"
-                grid [9][22].cellType = "obstacle"
-                grid [9][21].cellType = "obstacle"
-                grid [9][20].cellType = "obstacle"
+            if grid_choice not in grids:
+                raise ValueError(f"Unknown preset grid: {grid_choice}")
+            # Built once the seed is known, since preset 2's obstacles depend on it
+            grid = None
 
         elif grid_selection.lower() == "2":
             rows = int(input("Enter the number of rows for the grid: "))
@@ -828,16 +3170,18 @@ def main():
             )
             for _ in range(rows):
                 new_row = input()
-                if len(new_row) == rows:
+                if len(new_row) == cols:
                     custom_layout.append(new_row)
                 else:
                     print("Invalid length. A walkable row will be included instead.")
-                    custom_layout.append("".join(["0" * rows]))
+                    custom_layout.append("0" * cols)
             grid = create_grid(rows, cols, custom_layout)
+        elif grid_selection.lower() == "3":
+            path = input(
+                "Enter the path of a text ('0'/'X'/'E' per cell) or PNG floor plan: "
+            )
+            grid = load_layout(path)
 
-        walkable_count = sum(
-            1 for row in grid for cell in row if cell.cellType == "walkable"
-        )
         density = input_safe(
             "Enter population density as a percentage (0-100): ",
             lambda: random.randint(0, 100),
@@ -861,27 +3205,50 @@ def main():
         if not seed:
             seed = random.randint(0, 10000)
             print(f"No seed provided. Using random seed: {seed}")
-        random.seed(int(seed))
+        if grid is None:
+            grid = create_preset_grid(grid_choice, seed)
+        else:
+            grid.world.seed(seed)
 
         max_steps = input_safe(
             "Enter the number of simulation steps to take (any integer): ", lambda: 100
         )
-    total_people = int((density / 100) * walkable_count)
-    rows = len(grid)
-    cols = len(grid[0])
-    for _ in range(total_people):
-        while True:
-            i, j = random.randint(0, rows - 1), random.randint(0, cols - 1)
-            if grid[i][j].cellType == "walkable" and not grid[i][j].is_occupied():
-                is_rational = random.random() < (rational / 100)
-                is_strong = random.random() < (strong / 100)
-                is_relaxed = random.random() < (relaxed / 100)
-                grid[i][j].occupied = Person(
-                    is_strong, is_rational, is_relaxed, grid[i][j]
-                )
-                break
+        total_people = int((density / 100) * grid.count("walkable"))
+        placed = place_people(grid, total_people, rational, strong, relaxed)
+        if placed < total_people:
+            print(
+                f"Only {placed} free cells were left, "
+                f"so only {placed} people were placed."
+            )
 
-    run_simulation(grid, max_steps)
+    recorder = TrajectoryRecorder(record_path, grid) if record_path else None
+    after_step = recorder.record if recorder else None
+    profiler = StepProfiler() if timings_path else None
+
+    def run():
+        if export_path:
+            statistics = export_simulation(
+                grid, max_steps, export_path, after_step=after_step, profiler=profiler
+            )
+            print_statistics(statistics)
+            print(f"Saved {export_path}")
+        elif headless:
+            print_statistics(
+                simulate(grid, max_steps, after_step=after_step, profiler=profiler)
+            )
+        else:
+            run_simulation(grid, max_steps, after_step, profiler)
+
+    if profile_tool:
+        profile_call(run, tool=profile_tool)
+    else:
+        run()
+    if recorder:
+        recorder.close()
+        print(f"Saved {record_path}")
+    if profiler:
+        profiler.write(timings_path)
+        print(f"Saved {timings_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+import json
+import pickle
+import random
+
+import pytest
+
+import stampede
+
+
+def populated_preset(choice, seed, density=50):
+    grid = stampede.create_preset_grid(choice, seed)
+    walkable_count = grid.count("walkable")
+    stampede.place_people(grid, int((density / 100) * walkable_count), 50, 50, 50)
+    return grid
+
+
+def crowd(grid):
+    agents = grid.world.agents
+    return [
+        (
+            person.location.index,
+            agents.is_strong[person.id],
+            agents.is_rational[person.id],
+        )
+        for person in grid.world.people.values()
+    ]
+
+
+def test_negative_seed_is_reproducible():
+    first, second = populated_preset("2", -5), populated_preset("2", -5)
+    assert first.world.people
+    assert bytes(first.cell_types) == bytes(second.cell_types)
+    assert crowd(first) == crowd(second)
+    assert crowd(first) != crowd(populated_preset("2", 5))
+
+
+def test_negative_seed_numpy_streams():
+    grid = stampede.create_preset_grid("3", -5)
+    assert grid.world.generator("placement").random() == (
+        stampede.create_preset_grid("3", -5).world.generator("placement").random()
+    )
+
+
+def world_state(grid):
+    agents = grid.world.agents
+    return (
+        grid.occupants.tobytes(),
+        [getattr(agents, name).tobytes() for name in agents.FLAGS + agents.COUNTERS],
+        list(grid.world.people),
+    )
+
+
+def scenario(name):
+    if name.startswith("debug"):
+        return stampede.create_debug_scenario(name)
+    return populated_preset(name, 7), 40
+
+
+@pytest.mark.parametrize("name", ["debug1", "debug2", "3"])
+def test_movement_engines_match_every_step(name):
+    grid, steps = scenario(name)
+    loop, batched = grid, pickle.loads(pickle.dumps(grid))
+    for step_number in range(1, steps + 1):
+        stampede.step(loop, "loop")
+        stampede.step(batched, "batched")
+        assert world_state(loop) == world_state(
+            batched
+        ), f"engines diverge at step {step_number}"
+
+
+def test_unknown_pathfinding_mode_is_rejected():
+    grid, _ = stampede.create_debug_scenario("debug1")
+    with pytest.raises(ValueError):
+        stampede.find_paths(grid, "flowfield")
+
+
+def test_unknown_engine_is_rejected():
+    grid, _ = stampede.create_debug_scenario("debug1")
+    with pytest.raises(ValueError):
+        stampede.simulate(grid, 3, pathfinding="flow_field", engine="bogus")
+
+
+@pytest.mark.parametrize("text", ["", "\n\n", "  \r\n \n"])
+def test_empty_layout_is_rejected(tmp_path, text):
+    path = tmp_path / "empty.txt"
+    path.write_text(text)
+    with pytest.raises(ValueError, match="empty"):
+        stampede.read_layout(str(path))
+
+
+@pytest.mark.parametrize("density", [20, 80])
+def test_incremental_exit_tree_matches_a_fresh_search(density):
+    grid = populated_preset("3", 1, density)
+    profiler = stampede.StepProfiler()
+    for _ in range(15):
+        stampede.step(grid, pathfinding="incremental", profiler=profiler)
+        tree = grid.layout_cache["incremental_tree"]
+        tree.refresh()
+        assert tree.steps == stampede.ExitTree(grid, person_obstacles=True).steps
+    assert profiler.totals()["expansions"] > 0
+
+
+def test_sweep_resumes_after_a_partial_last_line(tmp_path):
+    results_path = str(tmp_path / "sweep.jsonl")
+    scenarios = [
+        dict(
+            layout="4",
+            seed=seed,
+            density=20,
+            rational=50,
+            strong=50,
+            relaxed=50,
+            steps=5,
+        )
+        for seed in (0, 1)
+    ]
+    with open(results_path, "w") as results_file:
+        results_file.write(json.dumps(stampede.run_scenario(**scenarios[0])) + "\n")
+        results_file.write('{"layout": "4", "se')
+    stampede.run_sweep(scenarios, results_path, workers=1)
+    results = stampede.load_sweep_results(results_path)
+    assert sorted(result["seed"] for result in results) == [0, 1]
+
+
+@pytest.mark.parametrize("choice, density", [("3", 20), ("3", 80), ("4", 50)])
+def test_sparse_stepping_matches_dense(choice, density):
+    dense = populated_preset(choice, 3, density)
+    sparse = pickle.loads(pickle.dumps(dense))
+    for step_number in range(1, 31):
+        stampede.step(dense)
+        stampede.step(sparse, sparse=True)
+        assert world_state(dense) == world_state(
+            sparse
+        ), f"differ at step {step_number}"
+
+
+@pytest.mark.parametrize("rows", [["0000", "XE"], ["000", "XE0", "000"], ["000"]])
+def test_ragged_layout_rows_are_rejected(rows):
+    with pytest.raises(ValueError):
+        stampede.create_grid(2, 3, rows)
+
+
+def test_layout_rows_map_to_their_cells():
+    grid = stampede.create_grid(2, 3, ["00X", "0E0"])
+    assert grid[0][2].cellType == "obstacle"
+    assert grid[1][1].cellType == "exit"
+    assert grid.count("walkable") == 4
+
+
+def test_simulate_seed_only_restarts_the_behaviour_stream():
+    grid = populated_preset("3", 11)
+    placement = grid.world.rng("placement").getstate()
+    stampede.simulate(grid, 3, seed=99)
+    assert grid.world.master_seed == 11
+    assert grid.world.rng("placement").getstate() == placement
+    other = stampede.create_preset_grid("3", 99)
+    assert grid.world.rng("behaviour").random() == other.world.rng("behaviour").random()
+
+
+@pytest.mark.parametrize("pathfinding", ["cached", "shared"])
+# At 5% density the cache also moves routes on to their next cell
+@pytest.mark.parametrize("choice, density", [("3", 5), ("3", 30), ("4", 60)])
+def test_routes_are_as_short_as_a_star(pathfinding, choice, density):
+    grid = populated_preset(choice, 5, density)
+    for _ in range(10):
+        paths = stampede.find_paths(grid, pathfinding)
+        for person, (path_with_obstacles, _) in paths.items():
+            expected = stampede.find_path(grid, person.location, True)
+            assert (path_with_obstacles is None) == (expected is None)
+            if expected is not None:
+                assert len(path_with_obstacles) == len(expected)
+                assert tuple(path_with_obstacles[0]) == tuple(expected[0])
+        stampede.step(grid, pathfinding=pathfinding)
+
+
+def agent_state(grid):
+    agents = grid.world.agents
+    ids = sorted(grid.world.people)
+    state = {"id": ids}
+    for name in ("x", "y", "is_fallen", "is_dead", "is_relaxed"):
+        state[name] = [getattr(agents, name)[person_id] for person_id in ids]
+    return state
+
+
+def test_trajectory_round_trip(tmp_path):
+    grid = populated_preset("3", 2)
+    path = str(tmp_path / "run.trj")
+    expected = [agent_state(grid)]
+    with stampede.TrajectoryRecorder(path, grid, chunk_steps=8) as recorder:
+
+        def after_step(grid, step_statistics):
+            recorder.record(grid)
+            expected.append(agent_state(grid))
+
+        stampede.simulate(grid, 60, after_step=after_step, until_settled=False)
+    reader = stampede.TrajectoryReader(path)
+    assert reader.steps == 60
+    for step_number, state in reader:
+        assert {name: list(values) for name, values in state.items()} == (
+            expected[step_number]
+        )
+
+
+def test_trajectory_records_long_moves(tmp_path):
+    # Steps that were not recorded add up to a move too long for a one-byte delta
+    grid = stampede.create_grid(1, 200, ["E" + "0" * 199])
+    person = stampede.Person(True, True, True, grid[0][199])
+    grid[0][199].occupied = person
+    path = str(tmp_path / "run.trj")
+    with stampede.TrajectoryRecorder(path, grid) as recorder:
+        stampede.simulate(grid, 150)
+        recorder.record(grid)
+    assert list(stampede.TrajectoryReader(path).state(1)["x"]) == [49]
+
+
+def test_pooled_simulate_rejects_other_modes_before_starting_workers(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("the pool was started")
+
+    monkeypatch.setattr(stampede, "PathfindingPool", no_pool)
+    grid, _ = stampede.create_debug_scenario("debug1")
+    with pytest.raises(ValueError):
+        stampede.simulate(grid, 3, pathfinding="shared", workers=2)
+
+
+def test_path_hierarchy_rebuilds_match_a_fresh_build():
+    # An open floor with a single exit, so walls reroute the routes of whole regions
+    layout = ["0" * 40 for _ in range(24)]
+    layout[12] = "E" + "0" * 39
+    grid = stampede.create_grid(24, 40, layout)
+    path_hierarchy = stampede.PathHierarchy(grid, cluster_size=4)
+    rng = random.Random(4)
+    walls = []
+    for _ in range(60):
+        # Put up a wall of up to 8 cells, or take an earlier one down again
+        if walls and rng.random() < 0.4:
+            cells, cell_type = walls.pop(rng.randrange(len(walls))), "walkable"
+        else:
+            start = rng.randrange(24 * 40)
+            cells = [
+                grid.cell(start + dx)
+                for dx in range(min(8, 40 - start % 40))
+                if grid.cell_types[start + dx] == stampede.WALKABLE
+            ]
+            walls.append(cells)
+            cell_type = "obstacle"
+        for cell in cells:
+            cell.cellType = cell_type
+        path_hierarchy.refresh()
+        fresh = stampede.PathHierarchy(grid, cluster_size=4)
+        assert path_hierarchy.exit_steps == fresh.exit_steps
+        for node, next_node in path_hierarchy.next_node.items():
+            if next_node is not None:
+                steps = (
+                    path_hierarchy.exit_steps[node]
+                    - path_hierarchy.exit_steps[next_node]
+                )
+                assert (next_node, steps) in path_hierarchy.neighbors(node)